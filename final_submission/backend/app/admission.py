@@ -0,0 +1,103 @@
+# Bounded concurrency and admission control for LLM generation.
+# At most max_concurrent generations run at once; up to max_queue more may wait
+# for max_wait_seconds. Anything beyond that is rejected straight away so the
+# endpoint can answer 503 instead of timing out.
+import asyncio
+import math
+import os
+import time
+from contextlib import asynccontextmanager
+
+# --- CONFIGURATION ---
+LLM_MAX_CONCURRENCY = int(os.environ.get("LLM_MAX_CONCURRENCY", 4))
+LLM_MAX_QUEUE = int(os.environ.get("LLM_MAX_QUEUE", 16))
+LLM_MAX_QUEUE_WAIT_SECONDS = float(os.environ.get("LLM_MAX_QUEUE_WAIT_SECONDS", 10))
+
+
+class AdmissionRejected(Exception):
+    """Raised when an LLM call cannot be admitted in time."""
+
+    def __init__(self, reason: str, retry_after: int):
+        super().__init__(reason)
+        self.retry_after = retry_after
+
+
+class LLMConcurrencyLimiter:
+    """
+    A semaphore with a bounded wait queue and a maximum wait time.
+    Use 'async with limiter.slot():' around each LLM call.
+    """
+
+    def __init__(self, max_concurrent: int = LLM_MAX_CONCURRENCY, max_queue: int = LLM_MAX_QUEUE, max_wait_seconds: float = LLM_MAX_QUEUE_WAIT_SECONDS):
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.max_wait_seconds = max_wait_seconds
+        self._semaphore = asyncio.Semaphore(max_concurrent)
+        self.active = 0
+        self.waiting = 0
+        self.rejected = 0
+        # Moving average of how long a generation holds its slot, used for Retry-After
+        self._avg_hold_seconds = 5.0
+
+    def is_full(self) -> bool:
+        """True if a new caller would be rejected without waiting."""
+        return self.waiting >= self.max_queue and self._semaphore.locked()
+
+    def retry_after(self) -> int:
+        """Rough number of seconds until a slot frees up for a new caller."""
+        rounds = (self.waiting + 1) / self.max_concurrent
+        return max(1, math.ceil(self._avg_hold_seconds * rounds))
+
+    def _reject(self, reason: str) -> AdmissionRejected:
+        self.rejected += 1
+        return AdmissionRejected(reason, self.retry_after())
+
+    async def _acquire(self) -> None:
+        if not self._semaphore.locked():
+            # A slot is free, so this returns without suspending
+            await self._semaphore.acquire()
+            return
+        if self.waiting >= self.max_queue:
+            raise self._reject("LLM wait queue is full")
+
+        self.waiting += 1
+        acquire_task = asyncio.ensure_future(self._semaphore.acquire())
+        try:
+            await asyncio.wait({acquire_task}, timeout=self.max_wait_seconds)
+        except asyncio.CancelledError:
+            # The request was cancelled while waiting; give back a slot we may just have got
+            if acquire_task.done() and not acquire_task.cancelled():
+                self._semaphore.release()
+            else:
+                acquire_task.cancel()
+            raise
+        finally:
+            self.waiting -= 1
+
+        if not acquire_task.done():
+            acquire_task.cancel()
+            raise self._reject("Timed out waiting for an LLM slot")
+
+    @asynccontextmanager
+    async def slot(self):
+        """Holds one generation slot for the duration of the block."""
+        await self._acquire()
+        self.active += 1
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.active -= 1
+            held = time.monotonic() - started
+            self._avg_hold_seconds = 0.8 * self._avg_hold_seconds + 0.2 * held
+            self._semaphore.release()
+
+    def stats(self) -> dict:
+        """Current queue state, for the health endpoint."""
+        return {
+            "active": self.active,
+            "waiting": self.waiting,
+            "max_concurrent": self.max_concurrent,
+            "max_queue": self.max_queue,
+            "rejected_total": self.rejected
+        }
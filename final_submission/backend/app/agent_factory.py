@@ -0,0 +1,437 @@
+# Reusable builder for the LangGraph visa agent.
+# The parts that are pure configuration (tool schemas, the compiled graph) are
+# built once per process tree, so they can be created in the master before
+# workers fork (gunicorn --preload) and shared copy-on-write. Anything that
+# holds a connection (Ollama clients, Chroma, the SQLite embedding cache) is
+# created lazily in each worker, because those must not cross a fork.
+import os
+import operator
+import threading
+import uuid
+from typing import Annotated, Callable, Generic, List, TypeVar, TypedDict
+
+from langchain_chroma import Chroma
+from langchain_core.embeddings import Embeddings
+from langchain_core.messages import AIMessage, BaseMessage, ToolMessage
+from langchain_core.tools import BaseTool, tool
+from langchain_core.utils.function_calling import convert_to_openai_tool
+from langchain_ollama import ChatOllama, OllamaEmbeddings
+from langgraph.graph import StateGraph, END
+
+# --- Selenium Imports ---
+from selenium.webdriver.common.by import By
+from selenium.webdriver.support.ui import WebDriverWait
+from selenium.webdriver.support import expected_conditions as EC
+from selenium.common.exceptions import TimeoutException
+
+# --- Local Imports ---
+from .embedding_cache import build_cached_embeddings
+from .embedding_batcher import EmbeddingBatcher
+from .admission import LLMConcurrencyLimiter, AdmissionRejected
+from .browser_pool import BrowserPool, BrowserPoolTimeout
+from .status_cache import StatusLookupCache
+from .intent_router import IntentRouter, INTENT_ROUTER_ENABLED
+from .tool_executor import ToolExecutor, user_facing_content
+from .status_tracker import (
+    HttpStatusTracker, JavaScriptRequired, TRACKING_HTTP_ENABLED, TRACKING_URL,
+    TRACKING_REF_FIELD_ID, TRACKING_DOB_FIELD_ID, TRACKING_SUBMIT_BUTTON_ID, TRACKING_STATUS_RESULT_ID
+)
+from .logging_setup import get_logger, set_stage
+from .metrics import AGENT_NODE_SECONDS, AGENT_TOOL_SECONDS, INTENT_ROUTES, STATUS_LOOKUPS, record_token_usage, register_cache, register_limiter
+
+# --- CONFIGURATION ---
+DB_PATH = os.environ.get("DB_PATH", r"D:\Chatbot\practice\chroma_db")
+OLLAMA_MODEL = os.environ.get("OLLAMA_MODEL", "mxbai-embed-large")
+LLM_MODEL = os.environ.get("LLM_MODEL", "llama3.1")
+K_DOCS = int(os.environ.get("K_DOCS", 3))
+# Tools whose output is sent to the user as-is, skipping the second agent pass (comma-separated)
+RETURN_DIRECT_TOOLS = {name.strip() for name in os.environ.get("RETURN_DIRECT_TOOLS", "general_visa_question_tool").split(",") if name.strip()}
+# Build the agent when the app module is imported, i.e. in the master process with gunicorn --preload
+AGENT_PRELOAD = os.environ.get("AGENT_PRELOAD", "false").lower() == "true"
+
+logger = get_logger("agent")
+
+T = TypeVar("T")
+
+
+class PerProcess(Generic[T]):
+    """
+    A value created on first use in each process. After a fork the child
+    gets its own instance instead of sharing the parent's connections.
+    """
+
+    def __init__(self, factory: Callable[[], T]):
+        self._factory = factory
+        self._value: T | None = None
+        self._pid: int | None = None
+        self._lock = threading.Lock()
+
+    def get(self) -> T:
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._value = self._factory()
+                    self._pid = os.getpid()
+        return self._value
+
+    def created(self) -> bool:
+        """True if this process already created the value."""
+        return self._pid == os.getpid()
+
+# --- Vector Store Loading ---
+
+def load_vectorstore(db_path: str, embedding_model: Embeddings) -> Chroma | None:
+    """Loads an existing Chroma vector store."""
+    if not os.path.exists(db_path):
+        print(f"Vector store directory {db_path} does not exist.")
+        return None
+    try:
+        print(f"Loading vector store from {db_path}...")
+        vectorstore = Chroma(
+            persist_directory=db_path,
+            embedding_function=embedding_model
+        )
+        print("Vector store loaded successfully.")
+        return vectorstore
+    except Exception as e:
+        print(f"Error loading vector store: {e}")
+        return None
+
+
+# -----------------------------------------------------------------
+# --- AGENT TOOLS ---
+# -----------------------------------------------------------------
+
+# HTTP-first status lookups, with warm headless browsers as the fallback (started per worker)
+status_tracker = HttpStatusTracker()
+browser_pool = BrowserPool()
+# Recent results by hashed credentials; identical concurrent lookups share one scrape
+status_cache = StatusLookupCache()
+
+
+class StatusLookupFailed(Exception):
+    """A lookup that failed; the message is what the user should be told."""
+
+
+async def lookup_visa_status(reference_no: str, date_of_birth: str) -> str:
+    """
+    Returns the raw status text from the tracking site ("" if none was shown).
+    Raises StatusLookupFailed if neither the HTTP mode nor the browser got an answer.
+    """
+    # 1. Lightweight mode: submit the form over HTTP and parse the HTML
+    if TRACKING_HTTP_ENABLED:
+        try:
+            status = await status_tracker.lookup(reference_no, date_of_birth)
+            STATUS_LOOKUPS.inc(mode="http", result="ok")
+            return status
+        except JavaScriptRequired as e:
+            STATUS_LOOKUPS.inc(mode="http", result="javascript")
+            logger.info("Tracking page needs JavaScript, using the browser: %s", e)
+        except Exception as e:
+            STATUS_LOOKUPS.inc(mode="http", result="error")
+            logger.warning("HTTP status lookup failed, using the browser: %s", e)
+
+    # 2. Fallback: a real browser from the pool
+    # This function contains blocking I/O (Selenium)
+    # It runs in a separate thread with a warm browser from the pool
+    def blocking_selenium_call(driver):
+        driver.get(TRACKING_URL)
+        ref_field = WebDriverWait(driver, 10).until(
+            EC.presence_of_element_located((By.ID, TRACKING_REF_FIELD_ID))
+        )
+        dob_field = driver.find_element(By.ID, TRACKING_DOB_FIELD_ID)
+        ref_field.send_keys(reference_no)
+        dob_field.send_keys(date_of_birth)
+        
+        submit_button = driver.find_element(By.ID, TRACKING_SUBMIT_BUTTON_ID)
+        submit_button.click()
+        
+        status_element = WebDriverWait(driver, 10).until(
+            EC.presence_of_element_located((By.ID, TRACKING_STATUS_RESULT_ID))
+        )
+        return status_element.text
+
+    # The pool recycles the browser if the lookup fails with anything but a timeout
+    try:
+        status = await browser_pool.run(blocking_selenium_call)
+        STATUS_LOOKUPS.inc(mode="browser", result="ok")
+        return status
+    except TimeoutException:
+        STATUS_LOOKUPS.inc(mode="browser", result="timeout")
+        raise StatusLookupFailed("Error: The tracking page timed out.")
+    except BrowserPoolTimeout:
+        STATUS_LOOKUPS.inc(mode="browser", result="busy")
+        raise StatusLookupFailed("Sorry, the tracking service is busy right now. Please try again in a moment.")
+    except Exception as e:
+        STATUS_LOOKUPS.inc(mode="browser", result="error")
+        logger.exception("Visa tracker tool error: %s", e)
+        raise StatusLookupFailed("Sorry, I was unable to retrieve the status.")
+
+@tool
+async def track_visa_status_tool(reference_no: str, date_of_birth: str) -> str:
+    """
+    Use this tool *only* when a user asks to track their visa application status.
+    You MUST have both the 'reference_no' (application reference number)
+    and 'date_of_birth' (in YYYY-MM-DD format) before calling this.
+    If you don't have them, ask the user for them.
+    """
+    set_stage("track_visa_status_tool")
+    logger.info("Calling visa tracker tool")
+
+    with AGENT_TOOL_SECONDS.time(tool="track_visa_status_tool"):
+        try:
+            status = await status_cache.get_or_lookup(
+                reference_no, date_of_birth, lambda: lookup_visa_status(reference_no, date_of_birth)
+            )
+        except StatusLookupFailed as e:
+            return str(e)
+
+    if not status:
+        return "Successfully submitted, but no status was found. Please check details."
+    return f"The status for application {reference_no} is: {status}"
+
+async def answer_visa_question(agent: "AgentComponents", query: str) -> str:
+    """Answers a general visa question from the knowledge base with the given agent's clients."""
+    set_stage("general_visa_question_tool")
+    logger.info("Calling RAG tool for: %s", query)
+    try:
+        with AGENT_TOOL_SECONDS.time(tool="general_visa_question_tool"):
+            # Embed through the batcher (the retriever would embed synchronously in a thread)
+            query_embedding = await agent.embeddings.aembed_query(query)
+            context_docs = await agent.vectorstore.asimilarity_search_by_vector(query_embedding, k=K_DOCS)
+            context_text = "\n".join([doc.page_content for doc in context_docs])
+            
+            rag_prompt = f"Context: {context_text}\n\nQuestion: {query}\nAnswer concisely."
+            async with agent.limiter.slot():
+                result = await agent.llm.ainvoke(rag_prompt)
+        record_token_usage(result, source="rag_tool")
+        return result.content
+    except AdmissionRejected:
+        # Let the endpoint turn this into a 503
+        raise
+    except Exception as e:
+        logger.exception("RAG tool error: %s", e)
+        return "Sorry, I encountered an error trying to find an answer."
+
+def build_general_visa_question_tool(agent: "AgentComponents") -> BaseTool:
+    """Creates the RAG tool bound to one AgentComponents (and so to its LLM and vector store)."""
+
+    @tool
+    async def general_visa_question_tool(query: str) -> str:
+        """
+        Use this tool for all general questions about visa processes,
+        document requirements, fees, application centers, or any other question
+        that is NOT a request to track a specific application status.
+        """
+        return await answer_visa_question(agent, query)
+
+    return general_visa_question_tool
+
+
+# -----------------------------------------------------------------
+# --- LANGGRAPH AGENT DEFINITION ---
+# -----------------------------------------------------------------
+
+class AgentState(TypedDict):
+    """This is the state of our graph, a list of messages."""
+    messages: Annotated[List[BaseMessage], operator.add]
+
+async def call_agent_node(state, llm_with_tools, limiter: LLMConcurrencyLimiter):
+    """This node calls the LLM (agent)."""
+    set_stage("agent")
+    logger.debug("Calling agent node")
+    messages = state['messages']
+    # We use .ainvoke for async calling, holding one of the limited LLM slots
+    with AGENT_NODE_SECONDS.time(node="agent"):
+        async with limiter.slot():
+            response = await llm_with_tools.ainvoke(messages)
+    record_token_usage(response, source="agent")
+    return {"messages": [response]}
+
+# Name given to tool calls made by the pre-router instead of the LLM
+ROUTER_NAME = "intent_router"
+
+async def route_intent_node(state, router: IntentRouter):
+    """
+    Pre-router: turns an obvious request into a direct tool call, so the LLM
+    isn't needed just to pick the tool. Unclear requests go to the agent.
+    """
+    set_stage("router")
+    question = state['messages'][-1]
+    with AGENT_NODE_SECONDS.time(node="router"):
+        decision = await router.route(str(question.content))
+    INTENT_ROUTES.inc(route=decision.tool or "agent", method=decision.method)
+    logger.info("Pre-router decision: %s (%s)", decision.tool or "agent", decision.reason)
+    if decision.tool is None:
+        return {"messages": []}
+    tool_call = {"name": decision.tool, "args": decision.args, "id": f"call_{uuid.uuid4().hex}"}
+    return {"messages": [AIMessage(content="", name=ROUTER_NAME, tool_calls=[tool_call])]}
+
+def after_router(state) -> str:
+    """Runs the tool the pre-router picked, or hands the turn to the agent."""
+    last_message = state['messages'][-1]
+    if isinstance(last_message, AIMessage) and last_message.tool_calls:
+        return "run_tools"
+    return "agent"
+
+def after_tools(state, return_direct: set) -> str:
+    """
+    Ends the turn with the tool output if the tools were pre-routed or are all
+    marked return_direct; otherwise the agent writes the answer up.
+    """
+    for message in reversed(state['messages']):
+        if isinstance(message, AIMessage):
+            if message.name == ROUTER_NAME:
+                return "finish"
+            if message.tool_calls and all(call["name"] in return_direct for call in message.tool_calls):
+                return "finish"
+            return "agent"
+    return "agent"
+
+def finish_with_tool_output(state):
+    """Turns the trailing tool result(s) into the final AI answer."""
+    outputs = []
+    for message in reversed(state['messages']):
+        if not isinstance(message, ToolMessage):
+            break
+        outputs.append(user_facing_content(message))
+    return {"messages": [AIMessage(content="\n\n".join(reversed(outputs)))]}
+
+def should_run_tools(state) -> str:
+    """This is the router. It checks if the LLM called a tool."""
+    last_message = state['messages'][-1]
+    if last_message.tool_calls:
+        logger.debug("Router decision: run tools %s", [call["name"] for call in last_message.tool_calls])
+        return "run_tools"
+    else:
+        logger.debug("Router decision: end")
+        return END
+
+# -----------------------------------------------------------------
+# --- AGENT FACTORY ---
+# -----------------------------------------------------------------
+
+class AgentComponents:
+    """
+    Everything the agent needs. Constructing it does no I/O: the tool schemas,
+    router and compiled graph are built here, while the LLM, embeddings and
+    vector store are created on first use in each process. Pass factories to
+    swap any of them (e.g. fakes in tests).
+    """
+
+    def __init__(self, llm_factory: Callable[[], ChatOllama] | None = None,
+                 embeddings_factory: Callable[[], Embeddings] | None = None,
+                 vectorstore_factory: Callable[[Embeddings], Chroma | None] | None = None):
+        # Tools and their JSON schemas (computed once, bound to the LLM lazily)
+        # The RAG tool is built per instance so it uses this instance's clients
+        self.tools = [track_visa_status_tool, build_general_visa_question_tool(self)]
+        # Kept here rather than on the (shared) tool objects; the graph's after_tools reads it
+        self.return_direct = {agent_tool.name for agent_tool in self.tools if agent_tool.name in RETURN_DIRECT_TOOLS}
+        self.tool_schemas = [convert_to_openai_tool(agent_tool) for agent_tool in self.tools]
+
+        # Every LLM call (agent node, RAG tool, history summaries) goes through this limiter
+        self.limiter = LLMConcurrencyLimiter()
+        self.tool_executor = ToolExecutor(self.tools)
+
+        # Per-process clients
+        # Cache misses for concurrent queries are batched into one Ollama call
+        self._embed_batcher = PerProcess(lambda: EmbeddingBatcher(OllamaEmbeddings(model=OLLAMA_MODEL)))
+        self._embeddings = PerProcess(
+            embeddings_factory or (lambda: build_cached_embeddings(OLLAMA_MODEL, underlying=self._embed_batcher.get()))
+        )
+        vectorstore_factory = vectorstore_factory or (lambda embeddings: load_vectorstore(DB_PATH, embeddings))
+        self._vectorstore = PerProcess(lambda: vectorstore_factory(self.embeddings))
+        self._llm = PerProcess(llm_factory or (lambda: ChatOllama(model=LLM_MODEL, temperature=0.4)))
+        self._llm_with_tools = PerProcess(lambda: self.llm.bind_tools(self.tool_schemas))
+        self._intent_router = PerProcess(lambda: IntentRouter(embeddings=self.embeddings))
+
+        self.graph = self._build_graph()
+
+    @property
+    def llm(self) -> ChatOllama:
+        return self._llm.get()
+
+    @property
+    def llm_with_tools(self):
+        return self._llm_with_tools.get()
+
+    @property
+    def embeddings(self) -> Embeddings:
+        return self._embeddings.get()
+
+    @property
+    def vectorstore(self) -> Chroma | None:
+        return self._vectorstore.get()
+
+    @property
+    def intent_router(self) -> IntentRouter:
+        return self._intent_router.get()
+
+    def _build_graph(self):
+        """Assembles and compiles the graph; nodes look up the per-process clients when they run."""
+        graph = StateGraph(AgentState)
+
+        # Closures pass this worker's components to the nodes (async defs, so LangGraph awaits them)
+        async def agent_node(state):
+            return await call_agent_node(state, self.llm_with_tools, self.limiter)
+
+        async def run_tools_node(state):
+            """Runs the requested tools, timing the whole node."""
+            with AGENT_NODE_SECONDS.time(node="tools"):
+                return await self.tool_executor.run(state)
+
+        # The pre-router answers obvious requests without the agent's tool-picking LLM call
+        async def router_node(state):
+            return await route_intent_node(state, self.intent_router)
+
+        graph.add_node("agent", agent_node)
+        # Tool calls of one turn run concurrently, each under its own deadline
+        graph.add_node("tools", run_tools_node)
+        graph.add_node("router", router_node)
+        graph.add_node("finish", finish_with_tool_output)
+
+        graph.set_entry_point("router" if INTENT_ROUTER_ENABLED else "agent")
+        graph.add_conditional_edges("router", after_router, {"run_tools": "tools", "agent": "agent"})
+        graph.add_conditional_edges("agent", should_run_tools, {"run_tools": "tools", END: END})
+        graph.add_conditional_edges("tools", lambda state: after_tools(state, self.return_direct), {"finish": "finish", "agent": "agent"})
+        graph.add_edge("finish", END)
+        return graph.compile()
+
+    async def start_worker(self) -> bool:
+        """
+        Per-worker startup: opens this process's clients and warms the browser pool.
+        Returns False if the LLM or vector store is unavailable.
+        """
+        register_limiter(self.limiter)
+        register_cache("embedding", self.embeddings)
+        register_cache("status_lookup", status_cache)
+        if self.vectorstore is None or self.llm is None:
+            return False
+        await browser_pool.start()
+        return True
+
+    async def aclose(self) -> None:
+        """Closes this process's clients."""
+        if self._embed_batcher.created():
+            await self._embed_batcher.get().aclose()
+        await browser_pool.close()
+        await status_tracker.aclose()
+        status_cache.invalidate()
+
+
+_agent: AgentComponents | None = None
+
+
+def get_agent() -> AgentComponents:
+    """Returns the shared agent, building it on first use."""
+    global _agent
+    if _agent is None:
+        _agent = AgentComponents()
+    return _agent
+
+
+def build_agent(**factories) -> AgentComponents:
+    """Builds (or rebuilds) the shared agent, e.g. with fake clients for tests."""
+    global _agent
+    _agent = AgentComponents(**factories)
+    return _agent
@@ -0,0 +1,123 @@
+# Bounded chat history for the LangGraph agent.
+# Before a user's history is saved, tool traffic from finished turns is dropped
+# and the oldest turns are trimmed to a token budget (optionally folded into a
+# rolling summary), so the prompt replayed on the next turn stays small.
+import os
+from typing import List, Tuple
+
+from langchain_core.language_models import BaseChatModel
+from langchain_core.messages import AIMessage, BaseMessage, HumanMessage, SystemMessage, ToolMessage, get_buffer_string
+
+from .admission import AdmissionRejected, LLMConcurrencyLimiter
+from .background_memory import SUMMARY_PROMPT
+from .logging_setup import get_logger
+from .metrics import record_token_usage
+
+# --- CONFIGURATION ---
+AGENT_HISTORY_MAX_TOKENS = int(os.environ.get("AGENT_HISTORY_MAX_TOKENS", 1500))
+# After trimming, the history is cut down to this fraction of the budget so trims are rare
+AGENT_HISTORY_TRIM_TARGET = float(os.environ.get("AGENT_HISTORY_TRIM_TARGET", 0.6))
+# drop: remove tool calls/results of finished turns; keep_last_turn: keep them for the latest turn only; keep: never remove
+AGENT_HISTORY_TOOL_POLICY = os.environ.get("AGENT_HISTORY_TOOL_POLICY", "keep_last_turn")
+# Fold trimmed turns into a rolling summary (one extra LLM call per trim) instead of forgetting them
+AGENT_HISTORY_SUMMARIZE = os.environ.get("AGENT_HISTORY_SUMMARIZE", "false").lower() == "true"
+
+SUMMARY_NAME = "conversation_summary"
+
+logger = get_logger("agent_history")
+
+
+def estimate_tokens(messages: List[BaseMessage]) -> int:
+    """~4 characters per token, counting tool-call arguments too."""
+    total = 0
+    for message in messages:
+        total += len(str(message.content))
+        if isinstance(message, AIMessage) and message.tool_calls:
+            total += len(str(message.tool_calls))
+    return total // 4
+
+
+def split_turns(messages: List[BaseMessage]) -> List[List[BaseMessage]]:
+    """Groups messages into turns, each starting at a HumanMessage."""
+    turns: List[List[BaseMessage]] = []
+    for message in messages:
+        if isinstance(message, HumanMessage) or not turns:
+            turns.append([])
+        turns[-1].append(message)
+    return turns
+
+
+def without_tool_messages(turn: List[BaseMessage]) -> List[BaseMessage]:
+    """Keeps the question and the final answer; drops tool calls and their results."""
+    return [
+        message for message in turn
+        if not isinstance(message, ToolMessage) and not (isinstance(message, AIMessage) and message.tool_calls)
+    ]
+
+
+def history_with_summary(messages: List[BaseMessage], summary: str) -> List[BaseMessage]:
+    """The messages to replay to the agent: the summary (if any) first."""
+    if not summary:
+        return list(messages)
+    return [SystemMessage(content=f"Summary of the earlier conversation:\n{summary}", name=SUMMARY_NAME)] + list(messages)
+
+
+class AgentHistoryManager:
+    """
+    Compacts an agent history before it is stored.
+    compact() returns (messages, summary); the summary lives beside the
+    messages in the session store and is re-inserted by history_with_summary().
+    """
+
+    def __init__(self, max_tokens: int = AGENT_HISTORY_MAX_TOKENS, tool_policy: str = AGENT_HISTORY_TOOL_POLICY,
+                 summarize: bool = AGENT_HISTORY_SUMMARIZE, trim_target: float = AGENT_HISTORY_TRIM_TARGET,
+                 llm: BaseChatModel | None = None, limiter: LLMConcurrencyLimiter | None = None):
+        if tool_policy not in ("drop", "keep_last_turn", "keep"):
+            raise ValueError(f"Unknown AGENT_HISTORY_TOOL_POLICY '{tool_policy}' (expected drop, keep_last_turn or keep).")
+        self.max_tokens = max_tokens
+        self.tool_policy = tool_policy
+        self.summarize = summarize and llm is not None
+        self.trim_target = trim_target
+        self.llm = llm
+        self.limiter = limiter
+
+    def _apply_tool_policy(self, turns: List[List[BaseMessage]]) -> List[List[BaseMessage]]:
+        if self.tool_policy == "keep":
+            return turns
+        keep_from = len(turns) - 1 if self.tool_policy == "keep_last_turn" else len(turns)
+        return [turn if i >= keep_from else without_tool_messages(turn) for i, turn in enumerate(turns)]
+
+    async def _fold_into_summary(self, summary: str, dropped: List[BaseMessage]) -> str:
+        prompt = SUMMARY_PROMPT.format(summary=summary, new_lines=get_buffer_string(dropped))
+        if self.limiter is not None:
+            async with self.limiter.slot():
+                result = await self.llm.ainvoke(prompt)
+        else:
+            result = await self.llm.ainvoke(prompt)
+        record_token_usage(result, source="agent_history")
+        return result.content
+
+    async def compact(self, messages: List[BaseMessage], summary: str = "") -> Tuple[List[BaseMessage], str]:
+        """Applies the tool policy, then trims whole turns (oldest first) to the token budget."""
+        # The summary message is re-created on load, so it is never stored among the messages
+        messages = [m for m in messages if not (isinstance(m, SystemMessage) and m.name == SUMMARY_NAME)]
+        turns = self._apply_tool_policy(split_turns(messages))
+
+        if estimate_tokens([m for turn in turns for m in turn]) > self.max_tokens:
+            target = int(self.max_tokens * self.trim_target)
+            dropped: List[BaseMessage] = []
+            # The latest turn is always kept
+            while len(turns) > 1 and estimate_tokens([m for turn in turns for m in turn]) > target:
+                dropped.extend(without_tool_messages(turns.pop(0)))
+            logger.debug("Trimmed %d messages from the agent history", len(dropped))
+
+            if self.summarize and dropped:
+                try:
+                    summary = await self._fold_into_summary(summary, dropped)
+                except AdmissionRejected:
+                    # No LLM capacity right now: those turns are forgotten rather than delaying the reply
+                    logger.warning("Skipped history summary, LLM queue is full")
+                except Exception as e:
+                    logger.exception("History summary error: %s", e)
+
+        return [m for turn in turns for m in turn], summary
@@ -0,0 +1,191 @@
+# Per-user conversation memory whose summarization runs off the request path.
+# The request only appends the raw turn; a background worker compacts histories
+# that grew past their token limit between requests.
+import asyncio
+from typing import Awaitable, Callable, Dict, List, Tuple
+
+from langchain_core.language_models import BaseChatModel
+from langchain_core.messages import AIMessage, BaseMessage, HumanMessage, SystemMessage, get_buffer_string
+
+from .admission import AdmissionRejected, LLMConcurrencyLimiter
+from .logging_setup import get_logger, bind_user
+
+logger = get_logger("memory")
+
+# Same wording as LangChain's ConversationSummaryBufferMemory summary prompt
+SUMMARY_PROMPT = (
+    "Progressively summarize the lines of conversation provided, adding onto the previous summary "
+    "returning a new summary.\n\n"
+    "Current summary:\n{summary}\n\n"
+    "New lines of conversation:\n{new_lines}\n\n"
+    "New summary:"
+)
+
+
+def estimate_tokens(messages: List[BaseMessage]) -> int:
+    """
+    Cheap token estimate (~4 characters per token).
+    Exact tokenization would cost more than it saves on the request path.
+    """
+    return sum(len(str(message.content)) for message in messages) // 4
+
+
+class BackgroundSummaryMemory:
+    """
+    Drop-in replacement for ConversationSummaryBufferMemory where pruning
+    and summarization are done by SummarizationWorker instead of save_context.
+    """
+
+    def __init__(self, llm: BaseChatModel, max_token_limit: int = 500, memory_key: str = "chat_history",
+                 limiter: LLMConcurrencyLimiter | None = None):
+        self.llm = llm
+        self.limiter = limiter
+        self.max_token_limit = max_token_limit
+        self.memory_key = memory_key
+        self.summary = ""
+        self.messages: List[BaseMessage] = []
+        # Bumped on every change, and stored with the snapshot so restore() can tell
+        # a stale session (e.g. written before a compaction was persisted) from a newer one
+        self.version = 0
+        # Guards self.summary / self.messages; only held for list operations, never during LLM calls
+        self.lock = asyncio.Lock()
+        # Ensures only one compaction per user runs at a time
+        self.compaction_lock = asyncio.Lock()
+
+    async def aload_memory_variables(self, inputs: dict) -> dict:
+        """Returns the summary (as a system message) followed by the raw messages."""
+        async with self.lock:
+            history: List[BaseMessage] = []
+            if self.summary:
+                history.append(SystemMessage(content=self.summary))
+            history.extend(self.messages)
+        return {self.memory_key: history}
+
+    async def asave_context(self, inputs: dict, outputs: dict) -> None:
+        """Appends the raw turn. Never calls the LLM."""
+        question = next(iter(inputs.values()))
+        answer = next(iter(outputs.values()))
+        async with self.lock:
+            self.messages.append(HumanMessage(content=question))
+            self.messages.append(AIMessage(content=answer))
+            self.version += 1
+
+    def needs_compaction(self) -> bool:
+        """True if the raw messages are over the token limit."""
+        return estimate_tokens(self.messages) > self.max_token_limit
+
+    async def compact(self) -> None:
+        """
+        Summarizes the oldest messages until the rest fit in max_token_limit.
+        Turns appended while the LLM is summarizing are kept untouched.
+        """
+        async with self.compaction_lock:
+            # 1. Pick the oldest messages to fold into the summary
+            async with self.lock:
+                to_prune: List[BaseMessage] = []
+                remaining = list(self.messages)
+                while remaining and estimate_tokens(remaining) > self.max_token_limit:
+                    to_prune.append(remaining.pop(0))
+                if not to_prune:
+                    return
+                previous_summary = self.summary
+
+            # 2. Summarize without holding the lock, so requests can keep appending
+            # The summary takes an LLM slot like any other generation (may raise AdmissionRejected)
+            prompt = SUMMARY_PROMPT.format(summary=previous_summary, new_lines=get_buffer_string(to_prune))
+            if self.limiter is not None:
+                async with self.limiter.slot():
+                    result = await self.llm.ainvoke(prompt)
+            else:
+                result = await self.llm.ainvoke(prompt)
+
+            # 3. Appends keep the pruned messages at the front; a restore() may have replaced them
+            async with self.lock:
+                if self.messages[:len(to_prune)] != to_prune:
+                    logger.info("History changed during summarization, discarding the summary")
+                    return
+                self.summary = result.content
+                del self.messages[:len(to_prune)]
+                self.version += 1
+
+    async def snapshot(self) -> Tuple[List[BaseMessage], str, int]:
+        """Returns (messages, summary, version) for persisting in a session store."""
+        async with self.lock:
+            return list(self.messages), self.summary, self.version
+
+    async def restore(self, messages: List[BaseMessage], summary: str, version: int = 0) -> bool:
+        """
+        Replaces the in-process state with one loaded from a session store,
+        unless this one is newer (e.g. a compaction that is not persisted yet).
+        Returns True if the state was replaced.
+        """
+        async with self.lock:
+            if version < self.version:
+                return False
+            self.messages = list(messages)
+            self.summary = summary
+            self.version = version
+            return True
+
+    def clear(self) -> None:
+        self.summary = ""
+        self.messages = []
+        self.version += 1
+
+
+class SummarizationWorker:
+    """
+    A background task queue that compacts overflowing per-user memories.
+    Each user is queued at most once at a time.
+    'on_compacted(user_id, memory)' is awaited after each compaction, e.g. to
+    write the new summary back to the session store.
+    """
+
+    def __init__(self, num_workers: int = 1, on_compacted: Callable[[str, BackgroundSummaryMemory], Awaitable[None]] | None = None):
+        self.num_workers = num_workers
+        self.on_compacted = on_compacted
+        self._queue: asyncio.Queue = asyncio.Queue()
+        self._pending: Dict[str, BackgroundSummaryMemory] = {}
+        self._tasks: List[asyncio.Task] = []
+
+    def start(self) -> None:
+        for i in range(self.num_workers):
+            self._tasks.append(asyncio.create_task(self._run(), name=f"summarizer-{i}"))
+
+    async def stop(self) -> None:
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def schedule(self, user_id: str, memory: BackgroundSummaryMemory) -> None:
+        """Queues a user's memory for compaction, unless it is already queued."""
+        if user_id in self._pending:
+            return
+        self._pending[user_id] = memory
+        self._queue.put_nowait(user_id)
+
+    @property
+    def queue_depth(self) -> int:
+        return self._queue.qsize()
+
+    async def _run(self) -> None:
+        while True:
+            user_id = await self._queue.get()
+            memory = self._pending.pop(user_id, None)
+            try:
+                if memory is not None and memory.needs_compaction():
+                    bind_user(user_id)
+                    logger.info("Summarizing chat history")
+                    await memory.compact()
+                    if self.on_compacted is not None:
+                        await self.on_compacted(user_id, memory)
+                    logger.info("Chat history summarized")
+            except AdmissionRejected:
+                # No LLM capacity right now; the next save of this user reschedules it
+                logger.warning("Skipped history summary, LLM queue is full")
+            except Exception as e:
+                # The raw turns are still there; the next save will reschedule it
+                logger.exception("Summarizer error: %s", e)
+            finally:
+                self._queue.task_done()
@@ -0,0 +1,191 @@
+# A pool of warm headless Chrome sessions for the visa tracking tool.
+# Launching Chrome takes seconds; reusing a running browser leaves only the
+# page navigation on the request path and caps how many Chrome processes a
+# burst of tracking requests can start.
+import asyncio
+import os
+from contextlib import asynccontextmanager
+from typing import Callable, List, TypeVar
+
+from selenium import webdriver
+from selenium.common.exceptions import TimeoutException
+
+from .logging_setup import get_logger
+
+# --- CONFIGURATION ---
+BROWSER_POOL_SIZE = int(os.environ.get("BROWSER_POOL_SIZE", 2))  # Max Chrome processes
+BROWSER_PREWARM = int(os.environ.get("BROWSER_PREWARM", BROWSER_POOL_SIZE))  # Sessions launched at startup
+BROWSER_MAX_USES = int(os.environ.get("BROWSER_MAX_USES", 50))  # Recycle a session after this many lookups
+BROWSER_CHECKOUT_TIMEOUT_SECONDS = float(os.environ.get("BROWSER_CHECKOUT_TIMEOUT_SECONDS", 30))
+
+logger = get_logger("browser_pool")
+
+T = TypeVar("T")
+
+
+class BrowserPoolTimeout(Exception):
+    """Raised when no browser session frees up within the checkout timeout."""
+
+
+def create_chrome_driver() -> webdriver.Chrome:
+    """Launches a headless Chrome with the same options the tracker always used."""
+    options = webdriver.ChromeOptions()
+    options.add_argument("--headless")
+    options.add_argument("--no-sandbox")
+    options.add_argument("--disable-dev-shm-usage")
+    return webdriver.Chrome(options=options)
+
+
+class BrowserSession:
+    """
+    One running browser plus its use count. All methods are blocking;
+    BrowserPool calls them from a worker thread.
+    """
+
+    def __init__(self, driver_factory: Callable[[], webdriver.Chrome] = create_chrome_driver, max_uses: int = BROWSER_MAX_USES):
+        self.driver = driver_factory()
+        self.max_uses = max_uses
+        self.uses = 0
+
+    @property
+    def expired(self) -> bool:
+        return self.uses >= self.max_uses
+
+    def is_healthy(self) -> bool:
+        """True if the browser still answers WebDriver commands."""
+        try:
+            self.driver.current_url
+            return True
+        except Exception:
+            return False
+
+    def reset(self) -> None:
+        """Drops cookies and the previous page so lookups don't see each other's state."""
+        self.driver.delete_all_cookies()
+        self.driver.get("about:blank")
+
+    def quit(self) -> None:
+        try:
+            self.driver.quit()
+        except Exception:
+            pass
+
+
+class BrowserPool:
+    """
+    Up to 'size' warm browser sessions, checked out with 'async with pool.session()'
+    or used through 'await pool.run(fn)'.
+    Sessions are health-checked on checkout, reset on return, and replaced after
+    'max_uses' lookups or when a lookup fails with anything but a page timeout.
+    """
+
+    def __init__(self, size: int = BROWSER_POOL_SIZE, max_uses: int = BROWSER_MAX_USES,
+                 checkout_timeout: float = BROWSER_CHECKOUT_TIMEOUT_SECONDS,
+                 driver_factory: Callable[[], webdriver.Chrome] = create_chrome_driver):
+        self.size = size
+        self.max_uses = max_uses
+        self.checkout_timeout = checkout_timeout
+        self.driver_factory = driver_factory
+        # Every live session is either idle or checked out, so this caps the number of browsers
+        self._semaphore = asyncio.Semaphore(size)
+        self._idle: List[BrowserSession] = []
+        self.in_use = 0
+        self.launched = 0
+        self.recycled = 0
+
+    def _launch(self) -> BrowserSession:
+        session = BrowserSession(self.driver_factory, self.max_uses)
+        self.launched += 1
+        return session
+
+    async def _discard(self, session: BrowserSession) -> None:
+        self.recycled += 1
+        await asyncio.to_thread(session.quit)
+
+    async def start(self, prewarm: int = BROWSER_PREWARM) -> None:
+        """Launches up to 'prewarm' sessions in parallel. Failures are logged, not raised."""
+        count = min(prewarm, self.size)
+        results = await asyncio.gather(
+            *(asyncio.to_thread(self._launch) for _ in range(count)), return_exceptions=True
+        )
+        for result in results:
+            if isinstance(result, BrowserSession):
+                self._idle.append(result)
+            else:
+                logger.error("Could not pre-launch browser session: %s", result)
+
+    async def _acquire(self) -> None:
+        acquire_task = asyncio.ensure_future(self._semaphore.acquire())
+        try:
+            await asyncio.wait({acquire_task}, timeout=self.checkout_timeout)
+        except asyncio.CancelledError:
+            if acquire_task.done() and not acquire_task.cancelled():
+                self._semaphore.release()
+            else:
+                acquire_task.cancel()
+            raise
+        if not acquire_task.done():
+            acquire_task.cancel()
+            raise BrowserPoolTimeout("Timed out waiting for a browser session")
+
+    async def _checkout(self) -> BrowserSession:
+        while self._idle:
+            session = self._idle.pop()
+            if not session.expired and await asyncio.to_thread(session.is_healthy):
+                return session
+            logger.info("Recycling browser session after %d uses", session.uses)
+            await self._discard(session)
+        return await asyncio.to_thread(self._launch)
+
+    @asynccontextmanager
+    async def session(self):
+        """Yields a warm BrowserSession for the duration of the block."""
+        await self._acquire()
+        session = None
+        broken = False
+        try:
+            session = await self._checkout()
+            self.in_use += 1
+            try:
+                yield session
+            except TimeoutException:
+                # The page was slow, the browser itself is fine
+                raise
+            except BaseException:
+                broken = True
+                raise
+            finally:
+                self.in_use -= 1
+                session.uses += 1
+        finally:
+            try:
+                if session is not None:
+                    if broken or session.expired:
+                        await self._discard(session)
+                    else:
+                        try:
+                            await asyncio.to_thread(session.reset)
+                            self._idle.append(session)
+                        except Exception:
+                            await self._discard(session)
+            finally:
+                self._semaphore.release()
+
+    async def run(self, fn: Callable[[webdriver.Chrome], T]) -> T:
+        """Runs the blocking fn(driver) in a thread with a pooled browser."""
+        async with self.session() as session:
+            return await asyncio.to_thread(fn, session.driver)
+
+    async def close(self) -> None:
+        """Quits every idle browser (call on shutdown)."""
+        idle, self._idle = self._idle, []
+        await asyncio.gather(*(asyncio.to_thread(session.quit) for session in idle))
+
+    def stats(self) -> dict:
+        return {
+            "size": self.size,
+            "idle": len(self._idle),
+            "in_use": self.in_use,
+            "launched_total": self.launched,
+            "recycled_total": self.recycled
+        }
@@ -0,0 +1,131 @@
+# Micro-batching of query embeddings for the FastAPI apps.
+# Concurrent requests each need one query vector; instead of one Ollama call per
+# request, queries arriving within a few milliseconds are sent as one batch.
+import asyncio
+import os
+from typing import List, Set, Tuple
+
+from langchain_core.embeddings import Embeddings
+
+# --- CONFIGURATION ---
+EMBED_BATCH_MAX_SIZE = int(os.environ.get("EMBED_BATCH_MAX_SIZE", 32))
+EMBED_BATCH_MAX_WAIT_MS = float(os.environ.get("EMBED_BATCH_MAX_WAIT_MS", 5))
+
+
+class EmbeddingBatcher(Embeddings):
+    """
+    Wraps an Embeddings object so that aembed_query calls are collected into
+    batches of up to max_batch_size, waiting at most max_wait_ms for a batch
+    to fill, and sent with a single aembed_documents call.
+    All other methods pass straight through to the underlying model.
+    """
+
+    def __init__(self, underlying: Embeddings, max_batch_size: int = EMBED_BATCH_MAX_SIZE, max_wait_ms: float = EMBED_BATCH_MAX_WAIT_MS):
+        self.underlying = underlying
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self._queue: asyncio.Queue | None = None
+        self._worker: asyncio.Task | None = None
+        self._in_flight: Set[asyncio.Task] = set()
+
+    # --- Pass-through methods ---
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self.underlying.embed_documents(texts)
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.underlying.embed_query(text)
+
+    async def aembed_documents(self, texts: List[str]) -> List[List[float]]:
+        return await self.underlying.aembed_documents(texts)
+
+    # --- Batched method ---
+
+    async def aembed_query(self, text: str) -> List[float]:
+        self._ensure_worker()
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((text, future))
+        return await future
+
+    def _ensure_worker(self) -> None:
+        # Started lazily so the batcher is bound to the server's event loop
+        if self._worker is None or self._worker.done():
+            self._queue = asyncio.Queue()
+            self._worker = asyncio.create_task(self._run(), name="embedding-batcher")
+
+    async def _collect_batch(self) -> List[Tuple[str, asyncio.Future]]:
+        """Waits for one query, then gathers more until the batch is full or max_wait passes."""
+        batch: List[Tuple[str, asyncio.Future]] = []
+        get_task = None
+        try:
+            batch.append(await self._queue.get())
+            loop = asyncio.get_running_loop()
+            deadline = loop.time() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                # Take anything already queued without waiting
+                if not self._queue.empty():
+                    batch.append(self._queue.get_nowait())
+                    continue
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
+                # asyncio.wait (unlike wait_for) never drops an item that arrives right at the deadline
+                get_task = asyncio.ensure_future(self._queue.get())
+                await asyncio.wait({get_task}, timeout=remaining)
+                if not get_task.done():
+                    get_task.cancel()
+                    break
+                batch.append(get_task.result())
+                get_task = None
+            return batch
+        except asyncio.CancelledError:
+            # Closing: the queries already taken off the queue would otherwise wait forever
+            if get_task is not None:
+                if get_task.done() and not get_task.cancelled():
+                    batch.append(get_task.result())
+                else:
+                    get_task.cancel()
+            _fail_batch(batch, RuntimeError("Embedding batcher is closed"))
+            raise
+
+    async def _run(self) -> None:
+        while True:
+            batch = await self._collect_batch()
+            # Dispatch without waiting, so the next batch can be collected meanwhile
+            task = asyncio.create_task(self._embed_batch(batch))
+            self._in_flight.add(task)
+            task.add_done_callback(self._in_flight.discard)
+
+    async def _embed_batch(self, batch: List[Tuple[str, asyncio.Future]]) -> None:
+        texts = [text for text, _ in batch]
+        try:
+            vectors = await self.underlying.aembed_documents(texts)
+        except Exception as e:
+            _fail_batch(batch, e)
+            return
+        for (_, future), vector in zip(batch, vectors):
+            if not future.done():
+                future.set_result(vector)
+
+    async def aclose(self) -> None:
+        """
+        Stops the worker and waits for batches that are already being embedded.
+        Queries that were not dispatched yet fail instead of waiting forever.
+        """
+        if self._worker is not None:
+            self._worker.cancel()
+            await asyncio.gather(self._worker, return_exceptions=True)
+            self._worker = None
+        if self._queue is not None:
+            queued = []
+            while not self._queue.empty():
+                queued.append(self._queue.get_nowait())
+            _fail_batch(queued, RuntimeError("Embedding batcher is closed"))
+        if self._in_flight:
+            await asyncio.gather(*self._in_flight, return_exceptions=True)
+
+
+def _fail_batch(batch: List[Tuple[str, asyncio.Future]], error: BaseException) -> None:
+    for _, future in batch:
+        if not future.done():
+            future.set_exception(error)
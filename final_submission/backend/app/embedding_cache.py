@@ -0,0 +1,215 @@
+# Exact-match embedding cache shared by the backend apps and the local ingestion scripts.
+# Wraps any LangChain Embeddings object (e.g. OllamaEmbeddings) and remembers vectors
+# keyed on (model name, hash of the normalized text).
+import asyncio
+import hashlib
+import os
+import sqlite3
+import threading
+import unicodedata
+from collections import OrderedDict
+from typing import List, Tuple
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+from langchain_ollama import OllamaEmbeddings
+
+# --- CONFIGURATION ---
+EMBEDDING_CACHE_SIZE = int(os.environ.get("EMBEDDING_CACHE_SIZE", 10000))
+# Leave empty to keep the cache in memory only
+EMBEDDING_CACHE_PATH = os.environ.get("EMBEDDING_CACHE_PATH", "")
+
+
+def normalize_text(text: str) -> str:
+    """Normalizes unicode and whitespace so trivial edits don't miss the cache."""
+    return " ".join(unicodedata.normalize("NFC", text).split())
+
+
+def cache_key(model_name: str, text: str) -> str:
+    """Builds the cache key for a (model, text) pair."""
+    digest = hashlib.sha256(normalize_text(text).encode("utf-8")).hexdigest()
+    return f"{model_name}:{digest}"
+
+
+class SQLiteEmbeddingStore:
+    """
+    On-disk tier of the embedding cache. Vectors are stored as raw float32 blobs.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, vector BLOB NOT NULL)"
+        )
+        self._conn.commit()
+
+    def get_many(self, keys: List[str]) -> dict:
+        """Returns {key: float32 array} for the keys found on disk."""
+        if not keys:
+            return {}
+        found = {}
+        with self._lock:
+            # SQLite limits the number of bound parameters, so query in slices
+            for start in range(0, len(keys), 500):
+                batch = keys[start:start + 500]
+                placeholders = ",".join("?" for _ in batch)
+                rows = self._conn.execute(
+                    f"SELECT key, vector FROM embeddings WHERE key IN ({placeholders})", batch
+                ).fetchall()
+                for key, blob in rows:
+                    found[key] = np.frombuffer(blob, dtype=np.float32)
+        return found
+
+    def put_many(self, items: dict) -> None:
+        """Stores {key: vector} on disk."""
+        if not items:
+            return
+        rows = [(key, np.asarray(vector, dtype=np.float32).tobytes()) for key, vector in items.items()]
+        with self._lock:
+            self._conn.executemany("INSERT OR REPLACE INTO embeddings (key, vector) VALUES (?, ?)", rows)
+            self._conn.commit()
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+
+class CachedEmbeddings(Embeddings):
+    """
+    An Embeddings wrapper with an in-process LRU tier and an optional SQLite tier.
+    Only texts that miss both tiers are sent to the underlying model.
+    Vectors are kept as float32 arrays (4 bytes per value instead of ~32 for a
+    list of Python floats) and converted back to lists when returned.
+    The async methods run the SQLite tier in a thread so the event loop never
+    waits on disk.
+    """
+
+    def __init__(self, underlying: Embeddings, model_name: str, max_size: int = EMBEDDING_CACHE_SIZE, disk_path: str = ""):
+        self.underlying = underlying
+        self.model_name = model_name
+        self.max_size = max_size
+        self.disk_store = SQLiteEmbeddingStore(disk_path) if disk_path else None
+        self._memory: "OrderedDict[str, np.ndarray]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    # --- Cache tiers ---
+
+    def _lookup_memory(self, keys: List[str]) -> Tuple[dict, List[str]]:
+        """Returns ({key: vector} found in the LRU tier, unique keys still missing)."""
+        found = {}
+        with self._lock:
+            for key in keys:
+                if key in self._memory:
+                    self._memory.move_to_end(key)
+                    found[key] = self._memory[key]
+        missing = [key for key in dict.fromkeys(keys) if key not in found]
+        return found, missing
+
+    def _lookup_disk(self, missing: List[str]) -> dict:
+        """Returns {key: vector} for the missing keys found on disk (blocking)."""
+        if self.disk_store is None or not missing:
+            return {}
+        from_disk = self.disk_store.get_many(missing)
+        self._remember(from_disk)
+        return from_disk
+
+    def _remember(self, items: dict) -> None:
+        """Adds vectors to the LRU tier, evicting the oldest entries if full."""
+        with self._lock:
+            for key, vector in items.items():
+                self._memory[key] = vector
+                self._memory.move_to_end(key)
+            while len(self._memory) > self.max_size:
+                self._memory.popitem(last=False)
+
+    def _split(self, texts: List[str]):
+        """Returns (keys, cached vectors, unique texts still to embed)."""
+        # Ollama embeds queries and documents the same way, so both share one key space
+        keys = [cache_key(self.model_name, text) for text in texts]
+        found, missing = self._lookup_memory(keys)
+        found.update(self._lookup_disk(missing))
+        return self._partition(texts, keys, found)
+
+    async def _asplit(self, texts: List[str]):
+        """Like _split, but reads the SQLite tier in a thread."""
+        keys = [cache_key(self.model_name, text) for text in texts]
+        found, missing = self._lookup_memory(keys)
+        if self.disk_store is not None and missing:
+            found.update(await asyncio.to_thread(self._lookup_disk, missing))
+        return self._partition(texts, keys, found)
+
+    def _partition(self, texts: List[str], keys: List[str], found: dict):
+        """Returns (keys, cached vectors, unique texts still to embed) and counts hits/misses."""
+        to_embed = {}
+        for key, text in zip(keys, texts):
+            if key not in found and key not in to_embed:
+                to_embed[key] = text
+        self.hits += len(texts) - sum(1 for key in keys if key in to_embed)
+        self.misses += len(to_embed)
+        return keys, found, to_embed
+
+    def _store(self, found: dict, new_keys: List[str], new_vectors: List[List[float]]) -> dict:
+        """Adds new vectors to 'found' and the LRU tier; returns them for the SQLite tier."""
+        new_items = {key: np.asarray(vector, dtype=np.float32) for key, vector in zip(new_keys, new_vectors)}
+        self._remember(new_items)
+        found.update(new_items)
+        return new_items
+
+    def _store_disk(self, new_items: dict) -> None:
+        if self.disk_store is not None:
+            self.disk_store.put_many(new_items)
+
+    async def _astore_disk(self, new_items: dict) -> None:
+        if self.disk_store is not None:
+            await asyncio.to_thread(self.disk_store.put_many, new_items)
+
+    # --- Embeddings interface ---
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        keys, found, to_embed = self._split(texts)
+        if to_embed:
+            vectors = self.underlying.embed_documents(list(to_embed.values()))
+            self._store_disk(self._store(found, list(to_embed.keys()), vectors))
+        return [found[key].tolist() for key in keys]
+
+    def embed_query(self, text: str) -> List[float]:
+        keys, found, to_embed = self._split([text])
+        if to_embed:
+            vector = self.underlying.embed_query(text)
+            self._store_disk(self._store(found, keys, [vector]))
+        return found[keys[0]].tolist()
+
+    async def aembed_documents(self, texts: List[str]) -> List[List[float]]:
+        keys, found, to_embed = await self._asplit(texts)
+        if to_embed:
+            vectors = await self.underlying.aembed_documents(list(to_embed.values()))
+            await self._astore_disk(self._store(found, list(to_embed.keys()), vectors))
+        return [found[key].tolist() for key in keys]
+
+    async def aembed_query(self, text: str) -> List[float]:
+        keys, found, to_embed = await self._asplit([text])
+        if to_embed:
+            vector = await self.underlying.aembed_query(text)
+            await self._astore_disk(self._store(found, keys, [vector]))
+        return found[keys[0]].tolist()
+
+
+def build_cached_embeddings(model_name: str, underlying: Embeddings | None = None) -> CachedEmbeddings:
+    """
+    Creates the cached OllamaEmbeddings used by every entry point.
+    Pass 'underlying' to cache something other than a plain OllamaEmbeddings
+    (e.g. the query batcher used by the FastAPI apps).
+    """
+    return CachedEmbeddings(
+        underlying=underlying if underlying is not None else OllamaEmbeddings(model=model_name),
+        model_name=model_name,
+        max_size=EMBEDDING_CACHE_SIZE,
+        disk_path=EMBEDDING_CACHE_PATH
+    )
@@ -0,0 +1,178 @@
+# Deterministic pre-router for the agent.
+# Obvious FAQ questions and tracking requests that already contain a reference
+# number and a labelled date of birth are sent straight to the right tool, skipping the
+# LLM call that would otherwise only pick the tool. Anything unclear is left
+# to the LLM agent.
+import asyncio
+import os
+import re
+from dataclasses import dataclass, field
+from datetime import date
+from typing import Dict, List, Tuple
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+# --- CONFIGURATION ---
+INTENT_ROUTER_ENABLED = os.environ.get("INTENT_ROUTER_ENABLED", "true").lower() == "true"
+# Optional embedding classifier, used when the keyword rules can't decide
+INTENT_CLASSIFIER_ENABLED = os.environ.get("INTENT_CLASSIFIER_ENABLED", "false").lower() == "true"
+INTENT_CLASSIFIER_MIN_SIMILARITY = float(os.environ.get("INTENT_CLASSIFIER_MIN_SIMILARITY", 0.75))
+INTENT_CLASSIFIER_MIN_MARGIN = float(os.environ.get("INTENT_CLASSIFIER_MIN_MARGIN", 0.05))
+
+FAQ_TOOL = "general_visa_question_tool"
+TRACK_TOOL = "track_visa_status_tool"
+
+TRACK_PATTERN = re.compile(
+    r"\b(track|tracking|status|where is my (application|passport|visa)|"
+    r"(my|our) (application|passport|visa) (ready|processed|approved|done))\b", re.I
+)
+FAQ_PATTERN = re.compile(
+    r"\b(visa|visas|fee|fees|document|documents|requirement|requirements|passport|appointment|"
+    r"photo|photos|insurance|processing time|centre|center|schengen|biometric|biometrics|"
+    r"invitation|itinerary|bank statement|apply|application form|embassy|consulate)\b", re.I
+)
+QUESTION_PATTERN = re.compile(r"\?|^\s*(what|which|how|when|where|who|do|does|can|is|are|should|must|list|tell me)\b", re.I)
+# Follow-ups only make sense with the chat history, which the RAG tool doesn't see
+FOLLOW_UP_PATTERN = re.compile(r"^\s*(and|also|what about|how about|same)\b|\b(it|its|that|this|those|these|they|them)\b", re.I)
+
+DATE_PATTERNS = [
+    (re.compile(r"\b(\d{4})[-/.](\d{1,2})[-/.](\d{1,2})\b"), ("y", "m", "d")),
+    (re.compile(r"\b(\d{1,2})[-/.](\d{1,2})[-/.](\d{4})\b"), ("a", "b", "y")),
+]
+# Only a date right after one of these counts as the date of birth (not e.g. an application date)
+DOB_LABEL = re.compile(r"\b(dob|d\.o\.b\.?|date of birth|birth ?date|birthday|born(\s+on)?)\s*(is|:|-|=)?\s*$", re.I)
+REFERENCE_CANDIDATE = re.compile(r"\b[A-Za-z0-9][A-Za-z0-9/\-]{4,29}\b")
+
+# Example queries for the embedding classifier
+EXEMPLARS: Dict[str, List[str]] = {
+    "faq": [
+        "What documents do I need for a tourist visa?",
+        "How much is the visa fee?",
+        "How long does visa processing take?",
+        "Do I need travel insurance for a Schengen visa?",
+        "What are the photo requirements?",
+        "How do I book an appointment at the visa centre?",
+    ],
+    "track": [
+        "I want to track my application",
+        "What is the status of my visa application?",
+        "Is my passport ready for collection?",
+        "Check my application status please",
+    ],
+    "other": [
+        "Hello",
+        "Thank you",
+        "Can you help me?",
+        "That's not what I asked",
+    ],
+}
+
+
+@dataclass
+class RouteDecision:
+    """The tool to call directly and its arguments, or tool=None for the LLM agent."""
+    tool: str | None
+    args: Dict[str, str] = field(default_factory=dict)
+    method: str = "rules"  # rules | classifier
+    reason: str = ""
+
+
+def extract_date_of_birth(text: str) -> Tuple[str | None, str, bool]:
+    """
+    Returns (YYYY-MM-DD or None, text without the date, whether the date is labelled as a DOB).
+    DD/MM vs MM/DD is only resolved when one part is over 12; otherwise None.
+    """
+    for pattern, order in DATE_PATTERNS:
+        matches = list(pattern.finditer(text))
+        if len(matches) != 1:
+            continue
+        match = matches[0]
+        parts = dict(zip(order, (int(g) for g in match.groups())))
+        if "a" in parts:
+            a, b = parts.pop("a"), parts.pop("b")
+            if a > 12 and b <= 12:
+                parts["d"], parts["m"] = a, b
+            elif b > 12 and a <= 12:
+                parts["m"], parts["d"] = a, b
+            else:
+                return None, text, False
+        try:
+            value = date(parts["y"], parts["m"], parts["d"])
+        except ValueError:
+            return None, text, False
+        labelled = DOB_LABEL.search(text[:match.start()]) is not None
+        return value.isoformat(), text[:match.start()] + " " + text[match.end():], labelled
+    return None, text, False
+
+
+def extract_reference_no(text: str) -> str | None:
+    """Returns the one token that looks like an application reference (5+ digits), else None."""
+    candidates = [token for token in REFERENCE_CANDIDATE.findall(text) if sum(c.isdigit() for c in token) >= 5]
+    return candidates[0] if len(candidates) == 1 else None
+
+
+class IntentRouter:
+    """
+    Keyword/regex rules, plus an optional nearest-exemplar classifier over
+    query embeddings. route() never calls the LLM.
+    """
+
+    def __init__(self, embeddings: Embeddings | None = None, use_classifier: bool = INTENT_CLASSIFIER_ENABLED,
+                 min_similarity: float = INTENT_CLASSIFIER_MIN_SIMILARITY, min_margin: float = INTENT_CLASSIFIER_MIN_MARGIN):
+        self.embeddings = embeddings if use_classifier else None
+        self.min_similarity = min_similarity
+        self.min_margin = min_margin
+        self._exemplar_vectors: Dict[str, np.ndarray] | None = None
+        self._exemplar_lock = asyncio.Lock()
+
+    def route_by_rules(self, text: str) -> RouteDecision | None:
+        """Returns a decision if the rules are confident, else None."""
+        date_of_birth, rest, labelled = extract_date_of_birth(text)
+        reference_no = extract_reference_no(rest)
+
+        if TRACK_PATTERN.search(text):
+            # The tool output is returned as-is, so only route when the arguments are unambiguous
+            if reference_no and date_of_birth and labelled:
+                return RouteDecision(TRACK_TOOL, {"reference_no": reference_no, "date_of_birth": date_of_birth},
+                                     reason="tracking request with credentials")
+            # The agent will ask for whatever is missing
+            return RouteDecision(None, reason="tracking request without clear credentials")
+
+        if reference_no or date_of_birth:
+            return None
+        if FAQ_PATTERN.search(text) and QUESTION_PATTERN.search(text) and not FOLLOW_UP_PATTERN.search(text):
+            if len(text.split()) >= 4:
+                return RouteDecision(FAQ_TOOL, {"query": text.strip()}, reason="self-contained visa question")
+        return None
+
+    async def _get_exemplar_vectors(self) -> Dict[str, np.ndarray]:
+        async with self._exemplar_lock:
+            if self._exemplar_vectors is None:
+                vectors = {}
+                for label, examples in EXEMPLARS.items():
+                    matrix = np.array(await self.embeddings.aembed_documents(examples), dtype=np.float32)
+                    vectors[label] = matrix / np.linalg.norm(matrix, axis=1, keepdims=True)
+                self._exemplar_vectors = vectors
+        return self._exemplar_vectors
+
+    async def classify(self, text: str) -> Tuple[str, float, float]:
+        """Returns (label, best similarity, margin over the runner-up label)."""
+        exemplars = await self._get_exemplar_vectors()
+        query = np.array(await self.embeddings.aembed_query(text), dtype=np.float32)
+        query /= np.linalg.norm(query)
+        scores = sorted(((float(np.max(vectors @ query)), label) for label, vectors in exemplars.items()), reverse=True)
+        (best, label), (runner_up, _) = scores[0], scores[1]
+        return label, best, best - runner_up
+
+    async def route(self, text: str) -> RouteDecision:
+        """Rules first, then the classifier (if enabled); otherwise the LLM agent."""
+        decision = self.route_by_rules(text)
+        if decision is not None:
+            return decision
+        if self.embeddings is not None and not FOLLOW_UP_PATTERN.search(text):
+            label, similarity, margin = await self.classify(text)
+            if label == "faq" and similarity >= self.min_similarity and margin >= self.min_margin:
+                return RouteDecision(FAQ_TOOL, {"query": text.strip()}, method="classifier",
+                                     reason=f"classifier similarity={similarity:.2f} margin={margin:.2f}")
+        return RouteDecision(None, reason="unsure")
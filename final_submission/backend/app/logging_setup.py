@@ -0,0 +1,150 @@
+# Structured, non-blocking logging for the request path.
+# Records are formatted as JSON (with request_id, user_id and stage taken from
+# context variables) and handed to a queue; a background thread does the actual
+# write to stdout, so the event loop never waits on I/O.
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import sys
+import time
+import uuid
+from contextvars import ContextVar
+
+# --- CONFIGURATION ---
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO").upper()
+# Fraction of requests whose DEBUG records are kept (only matters when LOG_LEVEL=DEBUG)
+LOG_DEBUG_SAMPLE_RATE = float(os.environ.get("LOG_DEBUG_SAMPLE_RATE", 0.1))
+
+ROOT_LOGGER_NAME = "rag"
+
+# --- Per-request context ---
+request_id_var: ContextVar[str | None] = ContextVar("request_id", default=None)
+user_id_var: ContextVar[str | None] = ContextVar("user_id", default=None)
+stage_var: ContextVar[str | None] = ContextVar("stage", default=None)
+debug_sampled_var: ContextVar[bool] = ContextVar("debug_sampled", default=False)
+
+
+def bind_request(request_id: str) -> None:
+    """Starts a new request context and decides whether its debug logs are sampled."""
+    request_id_var.set(request_id)
+    user_id_var.set(None)
+    stage_var.set(None)
+    debug_sampled_var.set(random.random() < LOG_DEBUG_SAMPLE_RATE)
+
+
+def bind_user(user_id: str) -> None:
+    user_id_var.set(user_id)
+
+
+def set_stage(stage: str | None) -> None:
+    """Marks the pipeline stage that following log records belong to."""
+    stage_var.set(stage)
+
+
+class ContextFilter(logging.Filter):
+    """
+    Copies the context variables onto each record and drops DEBUG records
+    from requests that were not sampled. Runs in the caller's context.
+    """
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.request_id = request_id_var.get()
+        record.user_id = user_id_var.get()
+        record.stage = stage_var.get()
+        if record.levelno <= logging.DEBUG and record.request_id is not None:
+            return debug_sampled_var.get()
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        payload = {
+            "ts": time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(record.created)) + f".{int(record.msecs):03d}Z",
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+            "request_id": getattr(record, "request_id", None),
+            "user_id": getattr(record, "user_id", None),
+            "stage": getattr(record, "stage", None),
+        }
+        if record.exc_info:
+            payload["exc_info"] = self.formatException(record.exc_info)
+        return json.dumps(payload, ensure_ascii=False)
+
+
+class _PreformattedQueueHandler(logging.handlers.QueueHandler):
+    """
+    Formats the record before queueing it: context variables only exist in
+    the caller, and QueueHandler would otherwise drop the traceback.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        message = self.format(record)
+        record = logging.makeLogRecord(record.__dict__)
+        record.msg = message
+        record.args = None
+        record.exc_info = None
+        record.exc_text = None
+        return record
+
+
+_listener: logging.handlers.QueueListener | None = None
+
+
+def setup_logging() -> logging.handlers.QueueListener:
+    """
+    Configures the 'rag' logger tree once and starts the background writer.
+    Safe to call from more than one app's lifespan.
+    """
+    global _listener
+    if _listener is not None:
+        return _listener
+
+    log_queue: queue.SimpleQueue = queue.SimpleQueue()
+
+    queue_handler = _PreformattedQueueHandler(log_queue)
+    queue_handler.setFormatter(JsonFormatter())
+    queue_handler.addFilter(ContextFilter())
+
+    stream_handler = logging.StreamHandler(sys.stdout)
+    stream_handler.setFormatter(logging.Formatter("%(message)s"))
+
+    root = logging.getLogger(ROOT_LOGGER_NAME)
+    root.setLevel(LOG_LEVEL)
+    root.handlers = [queue_handler]
+    root.propagate = False
+
+    _listener = logging.handlers.QueueListener(log_queue, stream_handler)
+    _listener.start()
+    return _listener
+
+
+def shutdown_logging() -> None:
+    """Flushes queued records and stops the background writer."""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+async def request_context_middleware(request, call_next):
+    """
+    HTTP middleware: gives every request an ID (or reuses X-Request-ID) that is
+    attached to its log records and echoed back in the response headers.
+    Register with app.middleware("http")(request_context_middleware).
+    """
+    request_id = request.headers.get("X-Request-ID") or uuid.uuid4().hex
+    bind_request(request_id)
+    response = await call_next(request)
+    response.headers["X-Request-ID"] = request_id
+    return response
+
+
+def get_logger(name: str) -> logging.Logger:
+    """Returns a logger under the 'rag' tree, e.g. get_logger('main') -> 'rag.main'."""
+    return logging.getLogger(f"{ROOT_LOGGER_NAME}.{name}")
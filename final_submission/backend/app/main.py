@@ -1,10 +1,15 @@
 # This is the main FastAPI application for the RAG chatbot backend.
 import uvicorn
 from fastapi import FastAPI, Request, HTTPException
+from fastapi.responses import StreamingResponse, PlainTextResponse
 from pydantic import BaseModel
-from typing import List, Dict, Any
+from typing import List, Dict, Any, AsyncIterator, Tuple
 from contextlib import asynccontextmanager
 import os
+import json
+import asyncio
+import time
+import warnings
 from cachetools import TTLCache
 
 # --- LangChain Imports ---
@@ -13,18 +18,49 @@ from langchain_ollama import OllamaEmbeddings
 from langchain_core.retrievers import BaseRetriever
 from langchain_ollama import ChatOllama
 from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
-from langchain_community.memory import ConversationSummaryBufferMemory
 from langchain_core.runnables import Runnable
 from langchain_core.documents import Document as LangChainDocument
 
+# --- Local Imports ---
+from .semantic_cache import SemanticAnswerCache
+from .embedding_cache import build_cached_embeddings
+from .embedding_batcher import EmbeddingBatcher
+from .background_memory import BackgroundSummaryMemory, SummarizationWorker
+from .session_store import SessionStore, build_session_store, SESSION_STORE
+from .admission import LLMConcurrencyLimiter, AdmissionRejected
+from .session_locks import SessionLocks, SessionTurn, RequestSuperseded
+from .logging_setup import setup_logging, shutdown_logging, get_logger, bind_user, set_stage, request_context_middleware
+from .metrics import REGISTRY, PROMETHEUS_CONTENT_TYPE, RAG_STAGE_SECONDS, record_token_usage, register_cache, register_limiter
+
 # --- CONFIGURATION (MODIFIED) ---
 # Load all settings from environment variables, with sensible defaults.
 DB_PATH = os.environ.get("DB_PATH", r"D:\Chatbot\practice\chroma_db")
 OLLAMA_MODEL = os.environ.get("OLLAMA_MODEL", "mxbai-embed-large")
 LLM_MODEL = os.environ.get("LLM_MODEL", "llama3.1")
 K_DOCS = int(os.environ.get("K_DOCS", 3)) # Ensure 'int'
+# Chunks with a relevance score (higher is better, 1 = exact match) below this are not sent to the LLM
+MIN_RELEVANCE_SCORE = float(os.environ.get("MIN_RELEVANCE_SCORE", 0.0))
 MAX_CACHE_SIZE = int(os.environ.get("MAX_CACHE_SIZE", 100))
 SESSION_TTL_SECONDS = int(os.environ.get("SESSION_TTL_SECONDS", 1800)) # (30 minutes)
+MEMORY_MAX_TOKENS = int(os.environ.get("MEMORY_MAX_TOKENS", 500))
+SUMMARY_WORKERS = int(os.environ.get("SUMMARY_WORKERS", 1)) # Background summarization tasks
+
+# Semantic answer cache: reuse answers for queries within a cosine distance of a cached one
+SEMANTIC_CACHE_ENABLED = os.environ.get("SEMANTIC_CACHE_ENABLED", "true").lower() == "true"
+SEMANTIC_CACHE_MAX_SIZE = int(os.environ.get("SEMANTIC_CACHE_MAX_SIZE", 500))
+SEMANTIC_CACHE_TTL_SECONDS = int(os.environ.get("SEMANTIC_CACHE_TTL_SECONDS", 3600)) # (1 hour)
+SEMANTIC_CACHE_MAX_DISTANCE = float(os.environ.get("SEMANTIC_CACHE_MAX_DISTANCE", 0.08))
+# How often to check whether the vector store was rebuilt (which clears the cache)
+SEMANTIC_CACHE_CHECK_INTERVAL_SECONDS = float(os.environ.get("SEMANTIC_CACHE_CHECK_INTERVAL_SECONDS", 30))
+# Users with chat history get follow-up answers that depend on context, so skip them by default
+SEMANTIC_CACHE_SKIP_WITH_HISTORY = os.environ.get("SEMANTIC_CACHE_SKIP_WITH_HISTORY", "true").lower() == "true"
+
+logger = get_logger("main")
+
+# l2 relevance scores below 0 are expected (see retrieve_scored_documents). LangChain warns about
+# each one with the retrieved chunks in the message, written synchronously to stderr, so silence
+# just that warning. A process-wide filter, since catch_warnings() isn't thread-safe.
+warnings.filterwarnings("ignore", message="Relevance scores must be between 0 and 1", category=UserWarning)
 
 # --- Pydantic Models ---
 class QueryRequest(BaseModel):
@@ -38,7 +74,7 @@ class Document(BaseModel):
     id: str
     content: str
     source: str
-    score: float  # We'll use a mock score for now
+    score: float  # Relevance score from the vector store (higher is better, 1 = exact match; can be < 0 with l2)
 
 # The full response model
 class QueryResponse(BaseModel):
@@ -83,6 +119,95 @@ def setup_retriever(vectorstore) -> BaseRetriever | None:
         search_kwargs={"k": K_DOCS}
     )
 
+async def get_user_memory(app_state, user_id: str, llm: ChatOllama) -> BackgroundSummaryMemory:
+    """
+    Returns the memory object for the given user, creating it if it doesn't exist.
+    The history itself is (re)loaded from the session store, which may have been
+    updated by another worker since this one last served the user. A stored
+    version older than the in-process one (a compaction whose write is still
+    pending) is ignored.
+    """
+    memory_dict = app_state.RAG_MEMORIES
+    if user_id not in memory_dict:
+        logger.info("Creating new memory for user")
+        # This is why we needed the 'llm' from app.state
+        memory_dict[user_id] = BackgroundSummaryMemory(
+            llm=llm,
+            max_token_limit=MEMORY_MAX_TOKENS,
+            memory_key="chat_history",
+            limiter=app_state.LLM_LIMITER
+        )
+    rag_memory = memory_dict[user_id]
+
+    session = await app_state.SESSION_STORE.get(user_id)
+    if session is not None:
+        await rag_memory.restore(session["messages"], session["summary"], session["version"])
+    return rag_memory
+
+async def persist_memory(session_store: SessionStore, user_id: str, rag_memory: BackgroundSummaryMemory) -> None:
+    """Writes the user's current history (messages + summary) to the session store."""
+    messages, summary, version = await rag_memory.snapshot()
+    await session_store.set(user_id, messages, summary, version)
+
+async def save_turn(app_state, user_id: str, rag_memory: BackgroundSummaryMemory, question: str, answer: str) -> None:
+    """
+    Appends the raw turn to the user's memory, persists it and, if the history
+    grew past its token limit, queues it for summarization in the background.
+    """
+    await rag_memory.asave_context({"question": question}, {"answer": answer})
+    await persist_memory(app_state.SESSION_STORE, user_id, rag_memory)
+    if rag_memory.needs_compaction():
+        app_state.RAG_SUMMARIZER.schedule(user_id, rag_memory)
+
+async def retrieve_scored_documents(vectorstore: Chroma, query: str) -> List[Tuple[LangChainDocument, float]]:
+    """
+    Runs a scored similarity search and drops chunks below MIN_RELEVANCE_SCORE.
+    Scores come from the vector store's relevance function for its distance
+    metric: higher is better and 1 is an exact match, but with Chroma's default
+    l2 metric unrelated chunks can score below 0.
+    The query was just embedded for the answer cache, so embedding it again
+    here is an embedding cache hit.
+    """
+    scored_docs = await asyncio.to_thread(
+        vectorstore.similarity_search_with_relevance_scores, query, K_DOCS
+    )
+
+    if MIN_RELEVANCE_SCORE <= 0:
+        # No cutoff configured; l2 relevance can dip below 0, so don't filter at all
+        return scored_docs
+
+    kept_docs = [(doc, score) for doc, score in scored_docs if score >= MIN_RELEVANCE_SCORE]
+    if len(kept_docs) < len(scored_docs):
+        logger.debug("Dropped %d documents below relevance %s", len(scored_docs) - len(kept_docs), MIN_RELEVANCE_SCORE)
+    return kept_docs
+
+def format_retrieved_documents(scored_docs: List[Tuple[LangChainDocument, float]]) -> List[Document]:
+    """
+    Converts retrieved LangChain documents and their scores into the API's Document model.
+    """
+    retrieved_documents_response: List[Document] = []
+    # Loop through the retrieved documents
+    for i, (doc, score) in enumerate(scored_docs):
+        retrieved_documents_response.append(
+            Document(
+                id=f"doc_{i}",
+                content=doc.page_content,
+                source=doc.metadata.get("source", "unknown"),
+                score=score
+            )
+        )
+    return retrieved_documents_response
+
+def use_answer_cache(answer_cache: SemanticAnswerCache | None, chat_history: list) -> bool:
+    """
+    Decides whether this request may read from / write to the semantic answer cache.
+    """
+    if answer_cache is None:
+        return False
+    if SEMANTIC_CACHE_SKIP_WITH_HISTORY and len(chat_history) > 0:
+        return False
+    return True
+
 
 
 # --- Lifespan Context Manager ---
@@ -95,10 +220,15 @@ async def lifespan(app: FastAPI):
     """
 
     print("--- Server is starting up, loading RAG components ---")
+    setup_logging()
 
 
     # 1. Load Embedding Model
-    embedding_model = OllamaEmbeddings(model=OLLAMA_MODEL)
+    # Cache misses for concurrent queries are batched into one Ollama call
+    embed_batcher = EmbeddingBatcher(OllamaEmbeddings(model=OLLAMA_MODEL))
+    app.state.RAG_EMBED_BATCHER = embed_batcher
+    embedding_model = build_cached_embeddings(OLLAMA_MODEL, underlying=embed_batcher)
+    app.state.RAG_EMBEDDINGS = embedding_model
     
 
     # 2. Load Vector Store
@@ -136,17 +266,55 @@ async def lifespan(app: FastAPI):
     # 6. Setup Chain
     app.state.RAG_CHAIN = app.state.RAG_PROMPT | app.state.RAG_LLM
 
+    # Limit how many generations run at once; extra requests wait in a bounded queue
+    app.state.LLM_LIMITER = LLMConcurrencyLimiter()
+    register_limiter(app.state.LLM_LIMITER)
+    register_cache("embedding", embedding_model)
+    print(f"LLM concurrency limiter initialized (concurrency={app.state.LLM_LIMITER.max_concurrent}, queue={app.state.LLM_LIMITER.max_queue}).")
+
     # 7. Setup Memory (as a dictionary for per-user storage)
     # Only initialize memory if LLM loaded, as it depends on it
     if app.state.RAG_LLM:
+        # Histories live in the session store (shared between workers for sqlite/redis);
+        # the TTLCache only keeps this worker's memory objects and their locks
+        app.state.SESSION_STORE = build_session_store()
+        print(f"Session store initialized (backend={SESSION_STORE}).")
+        # Requests of one user are serialized so concurrent turns can't overwrite each other's history
+        app.state.SESSION_LOCKS = SessionLocks()
+        print(f"Per-user request serialization enabled (cancel_superseded={app.state.SESSION_LOCKS.cancel_superseded}).")
         app.state.RAG_MEMORIES = TTLCache(
             maxsize=MAX_CACHE_SIZE,
             ttl=SESSION_TTL_SECONDS
         )
         print(f"Per-user memory manager initialized with TTLCache (size={MAX_CACHE_SIZE}, ttl={SESSION_TTL_SECONDS}s).")
+
+        # Summarization of long histories runs here, not inside requests
+        async def persist_compacted(user_id: str, rag_memory: BackgroundSummaryMemory) -> None:
+            await persist_memory(app.state.SESSION_STORE, user_id, rag_memory)
+
+        app.state.RAG_SUMMARIZER = SummarizationWorker(num_workers=SUMMARY_WORKERS, on_compacted=persist_compacted)
+        app.state.RAG_SUMMARIZER.start()
+        print(f"Background summarizer started ({SUMMARY_WORKERS} worker(s), limit={MEMORY_MAX_TOKENS} tokens).")
     else:
         print("LLM failed to load, memory not initialized.")
+        app.state.SESSION_STORE = None
+        app.state.SESSION_LOCKS = None
         app.state.RAG_MEMORIES = None
+        app.state.RAG_SUMMARIZER = None
+
+    # 8. Setup Semantic Answer Cache
+    if SEMANTIC_CACHE_ENABLED:
+        app.state.RAG_ANSWER_CACHE = SemanticAnswerCache(
+            db_path=DB_PATH,
+            max_size=SEMANTIC_CACHE_MAX_SIZE,
+            ttl_seconds=SEMANTIC_CACHE_TTL_SECONDS,
+            max_distance=SEMANTIC_CACHE_MAX_DISTANCE,
+            check_interval_seconds=SEMANTIC_CACHE_CHECK_INTERVAL_SECONDS
+        )
+        register_cache("semantic_answer", app.state.RAG_ANSWER_CACHE)
+        print(f"Semantic answer cache initialized (size={SEMANTIC_CACHE_MAX_SIZE}, ttl={SEMANTIC_CACHE_TTL_SECONDS}s, max_distance={SEMANTIC_CACHE_MAX_DISTANCE}).")
+    else:
+        app.state.RAG_ANSWER_CACHE = None
 
     print("--- RAG components loaded. Server startup complete. ---")
     
@@ -154,9 +322,17 @@ async def lifespan(app: FastAPI):
 
     # --- Shutdown Logic ---
     print("--- Server is shutting down ---")
+    await app.state.RAG_EMBED_BATCHER.aclose()
+    if app.state.RAG_SUMMARIZER:
+        await app.state.RAG_SUMMARIZER.stop()
     if app.state.RAG_MEMORIES:
         app.state.RAG_MEMORIES.clear() # Clear the cache on shutdown
+    if app.state.SESSION_STORE:
+        await app.state.SESSION_STORE.close()
+    if app.state.RAG_ANSWER_CACHE:
+        app.state.RAG_ANSWER_CACHE.invalidate()
     print("--- Shutdown complete ---")
+    shutdown_logging()
 
 
 # --- FastAPI Application ---
@@ -167,11 +343,28 @@ app = FastAPI(
     lifespan=lifespan  # Register the lifespan context manager
 )
 
+# Attach a request_id to every log record written while handling a request
+app.middleware("http")(request_context_middleware)
+
 # --- API Endpoints ---
 @app.get("/", tags=["General"])
-async def read_root():
-    """A simple health check endpoint."""
-    return {"status": "ok", "message": "Welcome to the RAG Chatbot API"}
+async def read_root(request: Request):
+    """A simple health check endpoint, including the current LLM queue depth."""
+    limiter = getattr(request.app.state, "LLM_LIMITER", None)
+    session_locks = getattr(request.app.state, "SESSION_LOCKS", None)
+    return {
+        "status": "ok",
+        "message": "Welcome to the RAG Chatbot API",
+        "llm_queue": limiter.stats() if limiter else None,
+        "sessions": session_locks.stats() if session_locks else None
+    }
+
+
+# --- Metrics Endpoint ---
+@app.get("/metrics", tags=["General"])
+async def read_metrics():
+    """Per-stage latency histograms, token counts and cache hit ratios in Prometheus format."""
+    return PlainTextResponse(REGISTRY.render(), media_type=PROMETHEUS_CONTENT_TYPE)
 
 
 # --- RAG Query Endpoint ---
@@ -180,19 +373,23 @@ async def handle_rag_query(request: Request, body: QueryRequest): # Use Request
     """
     The main RAG endpoint.
     1. Receives a query.
-    2. Retrieves relevant documents.
-    3. Loads chat history.
-    4. Augments the prompt with context and history.
-    5. Generates a response using an LLM.
-    6. Saves new history.
+    2. Loads chat history.
+    3. Returns a cached answer if a near-identical query was answered before.
+    4. Retrieves relevant documents.
+    5. Augments the prompt with context and history.
+    6. Generates a response using an LLM.
+    7. Saves new history.
     """
    
     try:
          # Access components from app.state
         retriever = request.app.state.RAG_RETRIEVER
+        vectorstore = request.app.state.RAG_VECTORSTORE
+        embedding_model = request.app.state.RAG_EMBEDDINGS
         rag_chain = request.app.state.RAG_CHAIN
         memory_dict = request.app.state.RAG_MEMORIES 
         llm = request.app.state.RAG_LLM
+        answer_cache = request.app.state.RAG_ANSWER_CACHE
 
         # Check if RAG components are loaded
         if retriever is None or rag_chain is None or memory_dict is None or llm is None:
@@ -207,81 +404,108 @@ async def handle_rag_query(request: Request, body: QueryRequest): # Use Request
         # Use a default ID if none is provided (e.g., for testing)
         # (The frontend sent this!)
         user_id = body.user_id if body.user_id else "default-user"
+        bind_user(user_id)
+
+        # Turns of one user run one at a time, so each one sees and extends the previous history
+        async def answer() -> QueryResponse:
+            # Get this user's specific memory, or create it if it doesn't exist
+            rag_memory = await get_user_memory(request.app.state, user_id, llm)
+
+
+
+
+            # 1. Load chat history (asynchronous)
+            set_stage("memory_load")
+            with RAG_STAGE_SECONDS.time(endpoint="query", stage="memory_load"):
+                chat_history_dict = await rag_memory.aload_memory_variables({})
+            chat_history = chat_history_dict['chat_history']
+            logger.debug("Loaded chat history with %d messages", len(chat_history))
+
+            # 2. Embed the query once; retrieval gets the same vector back from the embedding cache
+            set_stage("embedding")
+            with RAG_STAGE_SECONDS.time(endpoint="query", stage="embedding"):
+                query_embedding = await embedding_model.aembed_query(body.query)
+
+            cacheable = use_answer_cache(answer_cache, chat_history)
+            if cacheable:
+                set_stage("cache_lookup")
+                with RAG_STAGE_SECONDS.time(endpoint="query", stage="cache_lookup"):
+                    cached = answer_cache.lookup(query_embedding)
+                if cached is not None:
+                    logger.info("Semantic cache hit (matched: %r)", cached.query)
+                    turn.protect()
+                    await save_turn(request.app.state, user_id, rag_memory, body.query, cached.response)
+                    return QueryResponse(
+                        original_query=body.query,
+                        response=cached.response,
+                        retrieved_documents=cached.retrieved_documents
+                    )
+
+            # 3. Retrieve relevant documents
+            set_stage("retrieval")
+            with RAG_STAGE_SECONDS.time(endpoint="query", stage="retrieval"):
+                scored_docs = await retrieve_scored_documents(vectorstore, body.query)
+    
+            context_text = "\n".join([doc.page_content for doc, _ in scored_docs])
+            logger.debug("Retrieved %d documents for context", len(scored_docs))
 
-        # Get this user's specific memory, or create it if it doesn't exist
-        if user_id not in memory_dict:
-            print(f"Creating new memory for user: {user_id}")
-            # This is why we needed the 'llm' from app.state
-            memory_dict[user_id] = ConversationSummaryBufferMemory(
-                llm=llm,
-                max_token_limit=500,
-                memory_key="chat_history",
-                return_messages=True
-            )
-        # Get the specific memory object for this user
-        rag_memory = memory_dict[user_id]
+            # 4. Generate response (The "G" in RAG) (asynchronous)
+            set_stage("llm_generation")
+            wait_started = time.perf_counter()
+            async with request.app.state.LLM_LIMITER.slot():
+                RAG_STAGE_SECONDS.observe(time.perf_counter() - wait_started, endpoint="query", stage="llm_queue_wait")
+                with RAG_STAGE_SECONDS.time(endpoint="query", stage="llm_generation"):
+                    result = await rag_chain.ainvoke({
+                        "context": context_text,
+                        "question": body.query,
+                        "chat_history": chat_history
+                    })
 
+            response_content = result.content
+            record_token_usage(result, source="rag")
 
 
+            # 5. Save new history (asynchronous); a newer message no longer cancels the turn
+            turn.protect()
+            set_stage("memory_save")
+            with RAG_STAGE_SECONDS.time(endpoint="query", stage="memory_save"):
+                await save_turn(request.app.state, user_id, rag_memory, body.query, response_content)
 
-        # 1. Retrieve relevant documents
-        print("Retrieving relevant documents...")
-        context_docs: List[LangChainDocument] = await retriever.ainvoke(body.query)
-    
-        context_text = "\n".join([doc.page_content for doc in context_docs])
-        print(f"Retrieved {len(context_docs)} documents for context.")
-
-        # 2. Load chat history (asynchronous)
-        print(f"Loading chat history for user: {user_id}...")
-        chat_history_dict = await rag_memory.aload_memory_variables({})
-        chat_history = chat_history_dict['chat_history']
-        print(f"Loaded chat history with {len(chat_history)} messages.")
-
-        # 3. Generate response (The "G" in RAG) (asynchronous)
-        print("Generating response from LLM...")
-        result = await rag_chain.ainvoke({
-            "context": context_text,
-            "question": body.query,
-            "chat_history": chat_history
-        })
-
-        response_content = result.content
-        print("Response generated.")
-
-
-        # 4. Save new history (asynchronous)
-        print(f"Saving conversation to memory for user: {user_id}...") # <--- Added user_id to log
-        await rag_memory.save_context({"question": body.query}, {"answer": response_content})
-        print("Conversation saved.")
-
-
-        # 5. Format retrieved docs for the response (Score set to 0.0)
-        retrieved_documents_response: List[Document] = []
-        # Loop through the retrieved documents
-        for i, doc in enumerate(context_docs):
-            retrieved_documents_response.append(
-                Document(
-                    id=f"doc_{i}",
-                    content=doc.page_content,
-                    source=doc.metadata.get("source", "unknown"),
-                    score=0.0  # Score is set to 0.0 as retriever doesn't provide it
-                )
+
+            # 6. Format retrieved docs (with their relevance scores) for the response
+            set_stage("response_build")
+            with RAG_STAGE_SECONDS.time(endpoint="query", stage="response_build"):
+                retrieved_documents_response = format_retrieved_documents(scored_docs)
+
+                if cacheable:
+                    answer_cache.store(body.query, query_embedding, response_content, retrieved_documents_response)
+
+            # 7. Return the full response
+            return QueryResponse(
+                original_query=body.query,
+                response=response_content,
+                retrieved_documents=retrieved_documents_response
             )
 
-        # 6. Return the full response
-        return QueryResponse(
-            original_query=body.query,
-            response=response_content,
-            retrieved_documents=retrieved_documents_response
+        async with request.app.state.SESSION_LOCKS.turn(user_id) as turn:
+            return await turn.run(answer())
+
+    except RequestSuperseded:
+        # The same user sent a newer message; that one gets the answer
+        raise HTTPException(status_code=409, detail="Superseded by a newer message from the same user.")
+
+    except AdmissionRejected as e:
+        # Too many generations in flight; tell the client when to come back
+        logger.warning("Rejected query: %s", e)
+        raise HTTPException(
+            status_code=503,
+            detail="The server is busy. Please retry shortly.",
+            headers={"Retry-After": str(e.retry_after)}
         )
         
     except Exception as e:
-        # Log the full error for your own debugging
-        print(f"--- UNHANDLED ERROR ---")
-        print(f"Error handling query for user {body.user_id}: {e}")
-        import traceback
-        traceback.print_exc()
-        print(f"--- END TRACEBACK ---")
+        # Log the full error (with traceback) for your own debugging
+        logger.exception("Error handling query: %s", e)
 
         # Raise a clean HTTPException for the user
         raise HTTPException(
@@ -289,6 +513,153 @@ async def handle_rag_query(request: Request, body: QueryRequest): # Use Request
             detail=f"An internal server error occurred while processing your request."
         )
 
+
+# --- Streaming RAG Query Endpoint ---
+@app.post("/query/stream", tags=["RAG"])
+async def handle_rag_query_stream(request: Request, body: QueryRequest):
+    """
+    Streaming variant of /query. Responds with newline-delimited JSON (NDJSON).
+    1. A "documents" event as soon as retrieval finishes.
+    2. One "token" event per chunk generated by the LLM.
+    3. A final "done" event with the full response.
+    The conversation is saved to memory after the stream ends.
+    """
+    retriever = request.app.state.RAG_RETRIEVER
+    vectorstore = request.app.state.RAG_VECTORSTORE
+    embedding_model = request.app.state.RAG_EMBEDDINGS
+    rag_chain = request.app.state.RAG_CHAIN
+    memory_dict = request.app.state.RAG_MEMORIES
+    llm = request.app.state.RAG_LLM
+    answer_cache = request.app.state.RAG_ANSWER_CACHE
+
+    # Check if RAG components are loaded (before the stream starts, so we can still set a status code)
+    if retriever is None or rag_chain is None or memory_dict is None or llm is None:
+        raise HTTPException(status_code=503, detail="RAG components are not initialized. Check server logs.")
+
+    # Reject up front while we can still send a status code
+    limiter: LLMConcurrencyLimiter = request.app.state.LLM_LIMITER
+    if limiter.is_full():
+        raise HTTPException(
+            status_code=503,
+            detail="The server is busy. Please retry shortly.",
+            headers={"Retry-After": str(limiter.retry_after())}
+        )
+
+    user_id = body.user_id if body.user_id else "default-user"
+    bind_user(user_id)
+
+    async def rag_events(turn: SessionTurn) -> AsyncIterator[str]:
+        try:
+            rag_memory = await get_user_memory(request.app.state, user_id, llm)
+
+            # 1. Load chat history
+            set_stage("memory_load")
+            with RAG_STAGE_SECONDS.time(endpoint="stream", stage="memory_load"):
+                chat_history_dict = await rag_memory.aload_memory_variables({})
+            chat_history = chat_history_dict['chat_history']
+
+            # 2. Embed the query once and check the semantic answer cache
+            set_stage("embedding")
+            with RAG_STAGE_SECONDS.time(endpoint="stream", stage="embedding"):
+                query_embedding = await embedding_model.aembed_query(body.query)
+
+            cacheable = use_answer_cache(answer_cache, chat_history)
+            if cacheable:
+                set_stage("cache_lookup")
+                with RAG_STAGE_SECONDS.time(endpoint="stream", stage="cache_lookup"):
+                    cached = answer_cache.lookup(query_embedding)
+                if cached is not None:
+                    logger.info("Semantic cache hit (matched: %r)", cached.query)
+                    yield json.dumps({
+                        "type": "documents",
+                        "original_query": body.query,
+                        "retrieved_documents": [doc.model_dump() for doc in cached.retrieved_documents]
+                    }) + "\n"
+                    turn.protect()
+                    await save_turn(request.app.state, user_id, rag_memory, body.query, cached.response)
+                    yield json.dumps({"type": "done", "response": cached.response}) + "\n"
+                    return
+
+            # 3. Retrieve relevant documents and send them right away
+            set_stage("retrieval")
+            with RAG_STAGE_SECONDS.time(endpoint="stream", stage="retrieval"):
+                scored_docs = await retrieve_scored_documents(vectorstore, body.query)
+            context_text = "\n".join([doc.page_content for doc, _ in scored_docs])
+            logger.debug("Retrieved %d documents for context", len(scored_docs))
+
+            retrieved_documents_response = format_retrieved_documents(scored_docs)
+            yield json.dumps({
+                "type": "documents",
+                "original_query": body.query,
+                "retrieved_documents": [doc.model_dump() for doc in retrieved_documents_response]
+            }) + "\n"
+
+            # 4. Stream tokens from the LLM as they are generated
+            set_stage("llm_generation")
+            response_parts: List[str] = []
+            wait_started = time.perf_counter()
+            async with limiter.slot():
+                generation_started = time.perf_counter()
+                RAG_STAGE_SECONDS.observe(generation_started - wait_started, endpoint="stream", stage="llm_queue_wait")
+                async for chunk in rag_chain.astream({
+                    "context": context_text,
+                    "question": body.query,
+                    "chat_history": chat_history
+                }):
+                    record_token_usage(chunk, source="rag")  # Ollama reports usage on the last chunk
+                    if not chunk.content:
+                        continue
+                    if not response_parts:
+                        RAG_STAGE_SECONDS.observe(time.perf_counter() - generation_started, endpoint="stream", stage="first_token")
+                    response_parts.append(chunk.content)
+                    yield json.dumps({"type": "token", "content": chunk.content}) + "\n"
+                RAG_STAGE_SECONDS.observe(time.perf_counter() - generation_started, endpoint="stream", stage="llm_generation")
+
+            response_content = "".join(response_parts)
+
+            # 5. Save new history once the full answer is known
+            turn.protect()
+            set_stage("memory_save")
+            with RAG_STAGE_SECONDS.time(endpoint="stream", stage="memory_save"):
+                await save_turn(request.app.state, user_id, rag_memory, body.query, response_content)
+
+            if cacheable:
+                answer_cache.store(body.query, query_embedding, response_content, retrieved_documents_response)
+
+            yield json.dumps({"type": "done", "response": response_content}) + "\n"
+
+        except AdmissionRejected as e:
+            # Headers are already sent, so report the rejection in-band
+            logger.warning("Rejected streaming query: %s", e)
+            yield json.dumps({
+                "type": "error",
+                "detail": "The server is busy. Please retry shortly.",
+                "retry_after": e.retry_after
+            }) + "\n"
+
+        except Exception as e:
+            # Headers are already sent, so report the error in-band
+            logger.exception("Error streaming query: %s", e)
+            yield json.dumps({
+                "type": "error",
+                "detail": "An internal server error occurred while processing your request."
+            }) + "\n"
+
+    async def event_stream() -> AsyncIterator[str]:
+        # Turns of one user run one at a time; a newer message may cancel this one mid-stream
+        try:
+            async with request.app.state.SESSION_LOCKS.turn(user_id) as turn:
+                async for line in turn.iterate(rag_events(turn)):
+                    yield line
+        except RequestSuperseded:
+            yield json.dumps({
+                "type": "error",
+                "detail": "Superseded by a newer message from the same user.",
+                "superseded": True
+            }) + "\n"
+
+    return StreamingResponse(event_stream(), media_type="application/x-ndjson")
+
 # if __name__ == "__main__":
 #     """
 #     This allows you to run the app directly using `python main.py`
@@ -0,0 +1,222 @@
+# Minimal Prometheus-compatible metrics for the RAG and agent backends.
+# Histograms, counters and gauges are kept in-process and rendered in the
+# Prometheus text exposition format by the /metrics endpoint.
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, List, Tuple
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def _format_labels(label_names: List[str], label_values: Tuple[str, ...], extra: Dict[str, str] | None = None) -> str:
+    pairs = list(zip(label_names, label_values))
+    if extra:
+        pairs.extend(extra.items())
+    if not pairs:
+        return ""
+    escaped = []
+    for name, value in pairs:
+        value = str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        escaped.append(f'{name}="{value}"')
+    return "{" + ",".join(escaped) + "}"
+
+
+class _Metric:
+    metric_type = ""
+
+    def __init__(self, name: str, documentation: str, label_names: List[str] | None = None):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = list(label_names or [])
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        return tuple(str(labels.get(name, "")) for name in self.label_names)
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.metric_type}"]
+        lines.extend(self._samples())
+        return lines
+
+    def _samples(self) -> List[str]:
+        raise NotImplementedError
+
+
+class Counter(_Metric):
+    """A monotonically increasing value per label set."""
+    metric_type = "counter"
+
+    def __init__(self, name: str, documentation: str, label_names: List[str] | None = None):
+        super().__init__(name, documentation, label_names)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1.0, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def _samples(self) -> List[str]:
+        with self._lock:
+            return [f"{self.name}{_format_labels(self.label_names, key)} {value}" for key, value in self._values.items()]
+
+
+class Gauge(_Metric):
+    """A value that can go up and down, or be computed at scrape time."""
+    metric_type = "gauge"
+
+    def __init__(self, name: str, documentation: str, label_names: List[str] | None = None):
+        super().__init__(name, documentation, label_names)
+        self._values: Dict[Tuple[str, ...], float] = {}
+        self._functions: Dict[Tuple[str, ...], Callable[[], float]] = {}
+
+    def set(self, value: float, **labels) -> None:
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def set_function(self, function: Callable[[], float], **labels) -> None:
+        """Computes the value by calling 'function' on every scrape."""
+        with self._lock:
+            self._functions[self._key(labels)] = function
+
+    def _samples(self) -> List[str]:
+        with self._lock:
+            values = dict(self._values)
+            functions = dict(self._functions)
+        for key, function in functions.items():
+            try:
+                values[key] = float(function())
+            except Exception:
+                continue
+        return [f"{self.name}{_format_labels(self.label_names, key)} {value}" for key, value in values.items()]
+
+
+class Histogram(_Metric):
+    """Cumulative bucket counts, sum and count per label set."""
+    metric_type = "histogram"
+
+    def __init__(self, name: str, documentation: str, label_names: List[str] | None = None, buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, label_names)
+        self.buckets = tuple(sorted(buckets))
+        self._counts: Dict[Tuple[str, ...], List[int]] = {}
+        self._sums: Dict[Tuple[str, ...], float] = {}
+
+    def observe(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            counts = self._counts.setdefault(key, [0] * (len(self.buckets) + 1))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            counts[-1] += 1  # +Inf
+            self._sums[key] = self._sums.get(key, 0.0) + value
+
+    @contextmanager
+    def time(self, **labels):
+        """Observes the wall-clock duration of the block (works inside async code too)."""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def _samples(self) -> List[str]:
+        lines = []
+        with self._lock:
+            for key, counts in self._counts.items():
+                for bound, count in zip(self.buckets, counts):
+                    lines.append(f"{self.name}_bucket{_format_labels(self.label_names, key, {'le': repr(bound)})} {count}")
+                lines.append(f"{self.name}_bucket{_format_labels(self.label_names, key, {'le': '+Inf'})} {counts[-1]}")
+                lines.append(f"{self.name}_sum{_format_labels(self.label_names, key)} {self._sums[key]}")
+                lines.append(f"{self.name}_count{_format_labels(self.label_names, key)} {counts[-1]}")
+        return lines
+
+
+class MetricsRegistry:
+    """Holds every metric and renders them for the /metrics endpoint."""
+
+    def __init__(self):
+        self._metrics: Dict[str, _Metric] = {}
+
+    def _register(self, metric: _Metric) -> _Metric:
+        # Both apps may import this module; reuse a metric if it already exists
+        return self._metrics.setdefault(metric.name, metric)
+
+    def counter(self, name: str, documentation: str, label_names: List[str] | None = None) -> Counter:
+        return self._register(Counter(name, documentation, label_names))
+
+    def gauge(self, name: str, documentation: str, label_names: List[str] | None = None) -> Gauge:
+        return self._register(Gauge(name, documentation, label_names))
+
+    def histogram(self, name: str, documentation: str, label_names: List[str] | None = None, buckets=DEFAULT_BUCKETS) -> Histogram:
+        return self._register(Histogram(name, documentation, label_names, buckets))
+
+    def render(self) -> str:
+        lines: List[str] = []
+        for metric in self._metrics.values():
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+# --- Shared metrics ---
+REGISTRY = MetricsRegistry()
+PROMETHEUS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+RAG_STAGE_SECONDS = REGISTRY.histogram(
+    "rag_stage_duration_seconds", "Time spent in each stage of the /query RAG pipeline.", ["endpoint", "stage"]
+)
+AGENT_NODE_SECONDS = REGISTRY.histogram(
+    "agent_node_duration_seconds", "Time spent in each LangGraph agent node.", ["node"]
+)
+AGENT_TOOL_SECONDS = REGISTRY.histogram(
+    "agent_tool_duration_seconds", "Time spent in each agent tool.", ["tool"]
+)
+AGENT_TOOL_TIMEOUTS = REGISTRY.counter(
+    "agent_tool_timeouts_total", "Tool calls that missed their deadline.", ["tool"]
+)
+INTENT_ROUTES = REGISTRY.counter(
+    "intent_routes_total", "Agent turns by pre-router decision (tool or agent) and method.", ["route", "method"]
+)
+STATUS_LOOKUPS = REGISTRY.counter(
+    "status_lookups_total", "Visa status lookups by mode (http/browser) and result.", ["mode", "result"]
+)
+SESSION_SUPERSEDED = REGISTRY.counter(
+    "session_superseded_total", "Requests dropped because the same user sent a newer message, by stage (queued/running).", ["stage"]
+)
+LLM_TOKENS = REGISTRY.counter(
+    "llm_tokens_total", "Tokens processed by the LLM, by direction (input/output).", ["source", "direction"]
+)
+CACHE_HIT_RATIO = REGISTRY.gauge(
+    "cache_hit_ratio", "Hit ratio of each in-process cache since startup.", ["cache"]
+)
+CACHE_LOOKUPS = REGISTRY.gauge(
+    "cache_lookups", "Cache lookups since startup, by result (hit/miss).", ["cache", "result"]
+)
+LLM_QUEUE = REGISTRY.gauge(
+    "llm_queue", "Current LLM limiter state (active/waiting generations).", ["state"]
+)
+
+
+def record_token_usage(message, source: str) -> None:
+    """Adds an AIMessage's usage_metadata (if the model reported any) to LLM_TOKENS."""
+    usage = getattr(message, "usage_metadata", None)
+    if not usage:
+        return
+    LLM_TOKENS.inc(usage.get("input_tokens", 0), source=source, direction="input")
+    LLM_TOKENS.inc(usage.get("output_tokens", 0), source=source, direction="output")
+
+
+def register_cache(name: str, cache) -> None:
+    """Exposes a cache's 'hits' and 'misses' counters as gauges computed at scrape time."""
+    CACHE_LOOKUPS.set_function(lambda: cache.hits, cache=name, result="hit")
+    CACHE_LOOKUPS.set_function(lambda: cache.misses, cache=name, result="miss")
+    CACHE_HIT_RATIO.set_function(
+        lambda: cache.hits / (cache.hits + cache.misses) if (cache.hits + cache.misses) else 0.0,
+        cache=name
+    )
+
+
+def register_limiter(limiter) -> None:
+    """Exposes the LLM limiter's active/waiting counts as gauges."""
+    LLM_QUEUE.set_function(lambda: limiter.active, state="active")
+    LLM_QUEUE.set_function(lambda: limiter.waiting, state="waiting")
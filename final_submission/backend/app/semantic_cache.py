@@ -0,0 +1,138 @@
+# Semantic answer cache for the RAG chatbot backend.
+# Reuses a previous answer when a new query is "close enough" (cosine distance)
+# to a query we have already answered.
+import os
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Any, List
+
+import numpy as np
+
+from .logging_setup import get_logger
+
+logger = get_logger("semantic_cache")
+
+
+@dataclass
+class CachedAnswer:
+    """A single cached answer and the query embedding it was stored under."""
+    query: str
+    embedding: np.ndarray
+    response: str
+    retrieved_documents: List[Any]
+    created_at: float = field(default_factory=time.monotonic)
+
+
+def collection_fingerprint(db_path: str) -> tuple | None:
+    """
+    Returns a cheap fingerprint of the Chroma directory at db_path.
+    A full rebuild (rmtree + from_documents) changes the sqlite file and
+    the collection segment folders, so the fingerprint changes with it.
+    """
+    if not os.path.exists(db_path):
+        return None
+    try:
+        entries = []
+        for name in sorted(os.listdir(db_path)):
+            stat = os.stat(os.path.join(db_path, name))
+            entries.append((name, stat.st_mtime_ns, stat.st_size))
+        return tuple(entries)
+    except OSError:
+        return None
+
+
+class SemanticAnswerCache:
+    """
+    An LRU + TTL cache of RAG answers keyed on the query embedding.
+    A lookup returns the closest cached answer whose cosine distance to the
+    new query is within max_distance.
+    The Chroma directory is checked for a rebuild at most once every
+    check_interval_seconds, so lookups don't stat the disk every time.
+    """
+
+    def __init__(self, db_path: str, max_size: int = 500, ttl_seconds: int = 3600, max_distance: float = 0.08,
+                 check_interval_seconds: float = 30):
+        self.db_path = db_path
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self.max_distance = max_distance
+        self.check_interval_seconds = check_interval_seconds
+        self._entries: "OrderedDict[int, CachedAnswer]" = OrderedDict()
+        self._next_key = 0
+        self._fingerprint = collection_fingerprint(db_path)
+        self._checked_at = time.monotonic()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    @staticmethod
+    def _normalize(embedding) -> np.ndarray:
+        vector = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm > 0 else vector
+
+    def invalidate(self) -> None:
+        """Drops every cached answer."""
+        self._entries.clear()
+
+    def _check_collection(self) -> None:
+        """Clears the cache if the Chroma collection was rebuilt since the last check."""
+        now = time.monotonic()
+        if now - self._checked_at < self.check_interval_seconds:
+            return
+        self._checked_at = now
+        fingerprint = collection_fingerprint(self.db_path)
+        if fingerprint != self._fingerprint:
+            logger.info("Vector store changed on disk, invalidating semantic answer cache")
+            self._fingerprint = fingerprint
+            self.invalidate()
+
+    def _evict_expired(self) -> None:
+        now = time.monotonic()
+        # Entries are in LRU order, not insertion order, so check them all
+        expired = [key for key, entry in self._entries.items() if now - entry.created_at > self.ttl_seconds]
+        for key in expired:
+            del self._entries[key]
+
+    def lookup(self, embedding) -> CachedAnswer | None:
+        """
+        Returns the closest cached answer within max_distance, or None.
+        """
+        self._check_collection()
+        self._evict_expired()
+        if not self._entries:
+            self.misses += 1
+            return None
+
+        query_vector = self._normalize(embedding)
+        keys = list(self._entries.keys())
+        matrix = np.stack([self._entries[key].embedding for key in keys])
+        distances = 1.0 - matrix @ query_vector
+
+        best = int(np.argmin(distances))
+        if distances[best] > self.max_distance:
+            self.misses += 1
+            return None
+
+        key = keys[best]
+        self._entries.move_to_end(key)  # Mark as most recently used
+        self.hits += 1
+        return self._entries[key]
+
+    def store(self, query: str, embedding, response: str, retrieved_documents: List[Any]) -> None:
+        """
+        Stores an answer, evicting the least recently used entry if full.
+        """
+        self._check_collection()
+        self._entries[self._next_key] = CachedAnswer(
+            query=query,
+            embedding=self._normalize(embedding),
+            response=response,
+            retrieved_documents=list(retrieved_documents)
+        )
+        self._next_key += 1
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
@@ -0,0 +1,141 @@
+# Per-user serialization of chat turns.
+# Two requests from the same user_id would both load the history, both
+# generate, and both write it back, so one turn would be silently lost. Turns
+# of one user run one at a time here; optionally a newer message cancels the
+# older turn still in flight, so no LLM time is spent on a superseded answer.
+# The locks are per process: with several workers, route each user to one
+# worker (sticky sessions) for the same guarantee.
+import asyncio
+import os
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Coroutine, Dict, List, TypeVar
+
+from .logging_setup import get_logger
+from .metrics import SESSION_SUPERSEDED
+
+# --- CONFIGURATION ---
+# Cancel a user's in-flight request when the same user sends a newer message
+SESSION_CANCEL_SUPERSEDED = os.environ.get("SESSION_CANCEL_SUPERSEDED", "false").lower() == "true"
+
+logger = get_logger("session_locks")
+
+T = TypeVar("T")
+
+
+class RequestSuperseded(Exception):
+    """The same user sent a newer message, so this turn was dropped."""
+
+
+class SessionTurn:
+    """
+    One request's turn for a user. Run the work through run() (or iterate() for
+    a stream) so it can be cancelled when a newer message supersedes it.
+    """
+
+    def __init__(self):
+        self._superseded = asyncio.Event()
+        self._protected = False
+
+    @property
+    def superseded(self) -> bool:
+        return self._superseded.is_set()
+
+    def supersede(self) -> None:
+        if not self._protected:
+            self._superseded.set()
+
+    def protect(self) -> None:
+        """From here on the turn completes even if superseded (call it before saving the history)."""
+        self._protected = True
+
+    async def run(self, work: Coroutine[Any, Any, T]) -> T:
+        """Awaits 'work', raising RequestSuperseded if a newer message cancels it first."""
+        events = self.iterate(_once(work))
+        try:
+            async for result in events:
+                return result
+        finally:
+            await events.aclose()
+            work.close()  # No-op once it ran; avoids a "never awaited" warning if it didn't
+
+    async def iterate(self, events: AsyncIterator[T]) -> AsyncIterator[T]:
+        """Yields from 'events' until the turn is superseded; then stops it and raises RequestSuperseded."""
+        if self.superseded:
+            raise RequestSuperseded()
+        iterator = events.__aiter__()
+        superseded = asyncio.ensure_future(self._superseded.wait())
+        step = None
+        try:
+            while True:
+                step = asyncio.ensure_future(iterator.__anext__())
+                try:
+                    await asyncio.wait({step, superseded}, return_when=asyncio.FIRST_COMPLETED)
+                except asyncio.CancelledError:
+                    # The request went away: stop the work too
+                    step.cancel()
+                    raise
+                if not step.done():
+                    step.cancel()
+                    await asyncio.wait({step})
+                    SESSION_SUPERSEDED.inc(stage="running")
+                    logger.info("Cancelled a request superseded by a newer message")
+                    raise RequestSuperseded()
+                try:
+                    item = step.result()
+                except StopAsyncIteration:
+                    return
+                step = None
+                yield item
+        finally:
+            superseded.cancel()
+            if step is None and hasattr(iterator, "aclose"):
+                await iterator.aclose()
+
+
+async def _once(work: Coroutine[Any, Any, T]) -> AsyncIterator[T]:
+    yield await work
+
+
+class _Session:
+    def __init__(self):
+        self.lock = asyncio.Lock()
+        self.turns: List[SessionTurn] = []
+
+
+class SessionLocks:
+    """
+    An asyncio.Lock per user_id, created on demand and dropped once no request
+    for that user is running or waiting.
+    Use 'async with session_locks.turn(user_id) as turn:' around load-generate-save.
+    """
+
+    def __init__(self, cancel_superseded: bool = SESSION_CANCEL_SUPERSEDED):
+        self.cancel_superseded = cancel_superseded
+        self._sessions: Dict[str, _Session] = {}
+
+    @asynccontextmanager
+    async def turn(self, user_id: str) -> AsyncIterator[SessionTurn]:
+        session = self._sessions.setdefault(user_id, _Session())
+        turn = SessionTurn()
+        if self.cancel_superseded:
+            for older in session.turns:
+                older.supersede()
+        session.turns.append(turn)
+        try:
+            async with session.lock:
+                if turn.superseded:
+                    # A newer message arrived while this one was waiting: skip it
+                    SESSION_SUPERSEDED.inc(stage="queued")
+                    logger.info("Skipped a queued request superseded by a newer message")
+                    raise RequestSuperseded()
+                yield turn
+        finally:
+            session.turns.remove(turn)
+            if not session.turns:
+                self._sessions.pop(user_id, None)
+
+    def stats(self) -> dict:
+        return {
+            "users": len(self._sessions),
+            "waiting": sum(max(len(session.turns) - 1, 0) for session in self._sessions.values())
+        }
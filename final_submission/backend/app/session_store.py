@@ -0,0 +1,186 @@
+# Pluggable storage for per-user chat sessions.
+# Sessions are stored as zlib-compressed compact JSON so they can live outside
+# the process (SQLite file or a Redis-protocol server) and be shared by several
+# uvicorn workers.
+import asyncio
+import json
+import os
+import sqlite3
+import threading
+import time
+import zlib
+from abc import ABC, abstractmethod
+from typing import List
+
+from cachetools import TTLCache
+from langchain_core.messages import BaseMessage, messages_from_dict, messages_to_dict
+
+# --- CONFIGURATION ---
+SESSION_STORE = os.environ.get("SESSION_STORE", "memory")  # memory | sqlite | redis
+SESSION_STORE_MAX_SIZE = int(os.environ.get("SESSION_STORE_MAX_SIZE", 10000))  # memory backend only
+SESSION_STORE_PATH = os.environ.get("SESSION_STORE_PATH", "./sessions.sqlite3")
+SESSION_REDIS_URL = os.environ.get("SESSION_REDIS_URL", "redis://localhost:6379/0")
+SESSION_TTL_SECONDS = int(os.environ.get("SESSION_TTL_SECONDS", 1800))
+
+
+# --- Serialization ---
+
+def serialize_session(messages: List[BaseMessage], summary: str = "", version: int = 0) -> bytes:
+    """Packs a session into compressed, compact JSON."""
+    payload = {"summary": summary, "messages": messages_to_dict(messages), "version": version}
+    return zlib.compress(json.dumps(payload, separators=(",", ":")).encode("utf-8"))
+
+
+def deserialize_session(data: bytes) -> dict:
+    """Returns {"summary": str, "messages": List[BaseMessage], "version": int}."""
+    payload = json.loads(zlib.decompress(data).decode("utf-8"))
+    return {
+        "summary": payload.get("summary", ""),
+        "messages": messages_from_dict(payload.get("messages", [])),
+        "version": payload.get("version", 0)
+    }
+
+
+# --- Store interface ---
+
+class SessionStore(ABC):
+    """
+    Async key-value store of sessions keyed by user_id.
+    get() returns {"summary": str, "messages": List[BaseMessage], "version": int} or None.
+    'version' is an opaque counter of the writer's changes (0 if not tracked).
+    """
+
+    @abstractmethod
+    async def get(self, user_id: str) -> dict | None:
+        ...
+
+    @abstractmethod
+    async def set(self, user_id: str, messages: List[BaseMessage], summary: str = "", version: int = 0) -> None:
+        ...
+
+    @abstractmethod
+    async def delete(self, user_id: str) -> None:
+        ...
+
+    async def close(self) -> None:
+        pass
+
+
+class InMemorySessionStore(SessionStore):
+    """The original in-process TTLCache, now holding compact serialized sessions."""
+
+    def __init__(self, max_size: int = SESSION_STORE_MAX_SIZE, ttl_seconds: int = SESSION_TTL_SECONDS):
+        self._cache = TTLCache(maxsize=max_size, ttl=ttl_seconds)
+
+    async def get(self, user_id: str) -> dict | None:
+        data = self._cache.get(user_id)
+        return deserialize_session(data) if data is not None else None
+
+    async def set(self, user_id: str, messages: List[BaseMessage], summary: str = "", version: int = 0) -> None:
+        self._cache[user_id] = serialize_session(messages, summary, version)
+
+    async def delete(self, user_id: str) -> None:
+        self._cache.pop(user_id, None)
+
+    async def close(self) -> None:
+        self._cache.clear()
+
+
+class SQLiteSessionStore(SessionStore):
+    """
+    Sessions in a local SQLite file (WAL mode), shared by all workers on one machine.
+    Queries run in a thread so the event loop is never blocked on disk.
+    """
+
+    def __init__(self, path: str = SESSION_STORE_PATH, ttl_seconds: int = SESSION_TTL_SECONDS):
+        self.ttl_seconds = ttl_seconds
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS sessions (user_id TEXT PRIMARY KEY, data BLOB NOT NULL, expires_at REAL NOT NULL)"
+        )
+        self._conn.commit()
+
+    def _get(self, user_id: str) -> bytes | None:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT data FROM sessions WHERE user_id = ? AND expires_at > ?", (user_id, time.time())
+            ).fetchone()
+        return row[0] if row else None
+
+    def _set(self, user_id: str, data: bytes) -> None:
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO sessions (user_id, data, expires_at) VALUES (?, ?, ?)",
+                (user_id, data, time.time() + self.ttl_seconds)
+            )
+            # Expired rows are cleaned up lazily on writes
+            self._conn.execute("DELETE FROM sessions WHERE expires_at <= ?", (time.time(),))
+            self._conn.commit()
+
+    def _delete(self, user_id: str) -> None:
+        with self._lock:
+            self._conn.execute("DELETE FROM sessions WHERE user_id = ?", (user_id,))
+            self._conn.commit()
+
+    async def get(self, user_id: str) -> dict | None:
+        data = await asyncio.to_thread(self._get, user_id)
+        return deserialize_session(data) if data is not None else None
+
+    async def set(self, user_id: str, messages: List[BaseMessage], summary: str = "", version: int = 0) -> None:
+        await asyncio.to_thread(self._set, user_id, serialize_session(messages, summary, version))
+
+    async def delete(self, user_id: str) -> None:
+        await asyncio.to_thread(self._delete, user_id)
+
+    async def close(self) -> None:
+        with self._lock:
+            self._conn.close()
+
+
+class RedisSessionStore(SessionStore):
+    """
+    Sessions in any Redis-protocol server (Redis, Valkey, KeyDB...).
+    Pass 'client' to use an existing redis.asyncio-compatible client, e.g. a
+    fakeredis instance or a local stand-in server when testing.
+    """
+
+    def __init__(self, url: str = SESSION_REDIS_URL, ttl_seconds: int = SESSION_TTL_SECONDS, client=None, key_prefix: str = "session:"):
+        if client is None:
+            try:
+                import redis.asyncio as redis_asyncio
+            except ImportError as e:
+                raise ImportError("SESSION_STORE=redis needs the 'redis' package (pip install redis).") from e
+            client = redis_asyncio.from_url(url)
+        self._client = client
+        self.ttl_seconds = ttl_seconds
+        self.key_prefix = key_prefix
+
+    def _key(self, user_id: str) -> str:
+        return f"{self.key_prefix}{user_id}"
+
+    async def get(self, user_id: str) -> dict | None:
+        data = await self._client.get(self._key(user_id))
+        return deserialize_session(data) if data is not None else None
+
+    async def set(self, user_id: str, messages: List[BaseMessage], summary: str = "", version: int = 0) -> None:
+        await self._client.set(self._key(user_id), serialize_session(messages, summary, version), ex=self.ttl_seconds)
+
+    async def delete(self, user_id: str) -> None:
+        await self._client.delete(self._key(user_id))
+
+    async def close(self) -> None:
+        await self._client.aclose()
+
+
+def build_session_store(backend: str = SESSION_STORE) -> SessionStore:
+    """Creates the session store selected by SESSION_STORE."""
+    if backend == "memory":
+        return InMemorySessionStore()
+    if backend == "sqlite":
+        return SQLiteSessionStore()
+    if backend == "redis":
+        return RedisSessionStore()
+    raise ValueError(f"Unknown SESSION_STORE '{backend}' (expected memory, sqlite or redis).")
@@ -0,0 +1,73 @@
+# Short-lived cache of visa status lookups with single-flight coalescing.
+# Users tend to re-ask for their status within minutes; those repeats (and
+# concurrent identical lookups) share one scrape instead of hitting the
+# tracking site again. Credentials are only kept as a keyed hash.
+import asyncio
+import hashlib
+import hmac
+import os
+from typing import Awaitable, Callable, Dict
+
+from cachetools import TTLCache
+
+# --- CONFIGURATION ---
+STATUS_CACHE_TTL_SECONDS = int(os.environ.get("STATUS_CACHE_TTL_SECONDS", 120)) # (2 minutes)
+STATUS_CACHE_MAX_SIZE = int(os.environ.get("STATUS_CACHE_MAX_SIZE", 1000))
+
+
+def credentials_key(secret: bytes, reference_no: str, date_of_birth: str) -> str:
+    """
+    HMAC-SHA256 of the credentials. A per-process secret means the keys can't
+    be reversed by hashing every possible reference number / birth date.
+    """
+    message = f"{reference_no.strip()}\x00{date_of_birth.strip()}".encode("utf-8")
+    return hmac.new(secret, message, hashlib.sha256).hexdigest()
+
+
+class StatusLookupCache:
+    """
+    Maps hashed credentials to the raw status text for 'ttl_seconds'.
+    Only successful lookups are cached; a failure is shared with the callers
+    that were waiting on it, then the next call tries again.
+    """
+
+    def __init__(self, max_size: int = STATUS_CACHE_MAX_SIZE, ttl_seconds: int = STATUS_CACHE_TTL_SECONDS):
+        self._secret = os.urandom(32)
+        self._cache = TTLCache(maxsize=max_size, ttl=ttl_seconds)
+        self._in_flight: Dict[str, asyncio.Task] = {}
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    async def get_or_lookup(self, reference_no: str, date_of_birth: str, lookup: Callable[[], Awaitable[str]]) -> str:
+        """Returns the cached status, joins an identical lookup in progress, or runs 'lookup'."""
+        key = credentials_key(self._secret, reference_no, date_of_birth)
+
+        cached = self._cache.get(key)
+        if cached is not None:
+            self.hits += 1
+            return cached
+
+        task = self._in_flight.get(key)
+        if task is not None:
+            self.coalesced += 1
+            self.hits += 1
+        else:
+            self.misses += 1
+            task = asyncio.ensure_future(lookup())
+            self._in_flight[key] = task
+            task.add_done_callback(lambda t: self._finish(key, t))
+
+        # shield(): one caller going away must not cancel the lookup the others are waiting on
+        return await asyncio.shield(task)
+
+    def _finish(self, key: str, task: asyncio.Task) -> None:
+        self._in_flight.pop(key, None)
+        if not task.cancelled() and task.exception() is None:
+            self._cache[key] = task.result()
+
+    def invalidate(self) -> None:
+        self._cache.clear()
+
+    def __len__(self) -> int:
+        return len(self._cache)
@@ -0,0 +1,220 @@
+# Lightweight visa status lookups over plain HTTP.
+# The tracking form is fetched, filled in and submitted with a pooled async
+# HTTP client, and the status is parsed out of the returned HTML. The Selenium
+# browser is only needed when this fails or the page needs JavaScript.
+import os
+from http.cookiejar import CookieJar, DefaultCookiePolicy
+from html.parser import HTMLParser
+from typing import Dict, List, Tuple
+from urllib.parse import urlencode, urljoin
+
+import httpx
+
+# --- CONFIGURATION ---
+# !! The URL and element IDs are placeholders: take the real ones from the
+# BLS "Track Your Application" page using "Inspect Element".
+TRACKING_URL = os.environ.get("TRACKING_URL", "https://www.bls-website.com/track-application") # <-- REPLACE
+TRACKING_REF_FIELD_ID = os.environ.get("TRACKING_REF_FIELD_ID", "application_ref_id") # <-- REPLACE
+TRACKING_DOB_FIELD_ID = os.environ.get("TRACKING_DOB_FIELD_ID", "dob_field_id") # <-- REPLACE
+TRACKING_SUBMIT_BUTTON_ID = os.environ.get("TRACKING_SUBMIT_BUTTON_ID", "submit_button_id") # <-- REPLACE
+TRACKING_STATUS_RESULT_ID = os.environ.get("TRACKING_STATUS_RESULT_ID", "status_result_element_id") # <-- REPLACE
+
+TRACKING_HTTP_ENABLED = os.environ.get("TRACKING_HTTP_ENABLED", "true").lower() == "true"
+TRACKING_HTTP_TIMEOUT_SECONDS = float(os.environ.get("TRACKING_HTTP_TIMEOUT_SECONDS", 10))
+TRACKING_HTTP_MAX_CONNECTIONS = int(os.environ.get("TRACKING_HTTP_MAX_CONNECTIONS", 10))
+
+MAX_REDIRECTS = 5
+USER_AGENT = "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0 Safari/537.36"
+
+VOID_ELEMENTS = {"area", "base", "br", "col", "embed", "hr", "img", "input", "link", "meta", "source", "track", "wbr"}
+
+
+class HttpLookupError(Exception):
+    """The HTTP lookup failed (network error, bad status code or unexpected page)."""
+
+
+class JavaScriptRequired(HttpLookupError):
+    """The page only works with JavaScript, so it needs the browser."""
+
+
+class _TrackingPageParser(HTMLParser):
+    """
+    Collects the form that contains 'field_id' (action, method, fields) and the
+    text of the element with id 'status_id'.
+    """
+
+    def __init__(self, field_id: str, submit_id: str, status_id: str):
+        super().__init__(convert_charrefs=True)
+        self.field_id = field_id
+        self.submit_id = submit_id
+        self.status_id = status_id
+        self.has_noscript = False
+        self.script_count = 0
+        # The form that contains field_id
+        self.form: dict | None = None
+        self._current_form: dict | None = None
+        self._textarea_name: str | None = None
+        # Text capture for the status element
+        self.status_text: str | None = None
+        self._status_depth = 0
+        self._status_parts: List[str] = []
+
+    def handle_starttag(self, tag, attrs):
+        attrs = dict(attrs)
+        if tag == "script":
+            self.script_count += 1
+        elif tag == "noscript":
+            self.has_noscript = True
+
+        if self._status_depth:
+            if tag not in VOID_ELEMENTS:
+                self._status_depth += 1
+        elif attrs.get("id") == self.status_id:
+            self._status_parts = []
+            self._status_depth = 0 if tag in VOID_ELEMENTS else 1
+            if not self._status_depth:
+                self.status_text = attrs.get("value", "")
+
+        if tag == "form":
+            self._current_form = {"action": attrs.get("action") or "", "method": (attrs.get("method") or "get").lower(), "fields": [], "ids": {}}
+        elif self._current_form is not None and tag in ("input", "select", "textarea", "button"):
+            self._add_field(tag, attrs)
+
+    def _add_field(self, tag, attrs):
+        form = self._current_form
+        name = attrs.get("name")
+        element_id = attrs.get("id")
+        if element_id and name:
+            form["ids"][element_id] = name
+        if element_id == self.field_id:
+            self.form = form
+        if not name:
+            return
+        field_type = (attrs.get("type") or ("submit" if tag == "button" else "text")).lower()
+        # Only the submit button we "click" is sent, like a browser would
+        if field_type in ("submit", "image", "button") and element_id != self.submit_id:
+            return
+        if field_type in ("checkbox", "radio") and "checked" not in attrs:
+            return
+        if tag == "textarea":
+            self._textarea_name = name
+        form["fields"].append((name, attrs.get("value", "")))
+
+    def handle_endtag(self, tag):
+        if tag == "form":
+            self._current_form = None
+        elif tag == "textarea":
+            self._textarea_name = None
+        if self._status_depth and tag not in VOID_ELEMENTS:
+            self._status_depth -= 1
+            if not self._status_depth:
+                self.status_text = " ".join("".join(self._status_parts).split())
+
+    def handle_data(self, data):
+        if self._status_depth:
+            self._status_parts.append(data)
+        if self._textarea_name and self._current_form is not None:
+            fields = self._current_form["fields"]
+            name, value = fields[-1]
+            fields[-1] = (name, value + data)
+
+
+def _parse(html: str) -> _TrackingPageParser:
+    parser = _TrackingPageParser(TRACKING_REF_FIELD_ID, TRACKING_SUBMIT_BUTTON_ID, TRACKING_STATUS_RESULT_ID)
+    parser.feed(html)
+    parser.close()
+    return parser
+
+
+def _looks_javascript_only(parser: _TrackingPageParser) -> bool:
+    return parser.has_noscript or parser.script_count > 0
+
+
+class HttpStatusTracker:
+    """
+    Submits the tracking form with a shared httpx.AsyncClient (one connection
+    pool per worker). Cookies are kept per lookup, never on the shared client,
+    so concurrent users can't see each other's sessions.
+    """
+
+    def __init__(self, url: str = TRACKING_URL, timeout: float = TRACKING_HTTP_TIMEOUT_SECONDS,
+                 max_connections: int = TRACKING_HTTP_MAX_CONNECTIONS, transport: httpx.AsyncBaseTransport | None = None):
+        self.url = url
+        self.timeout = timeout
+        self.max_connections = max_connections
+        self.transport = transport
+        self._client: httpx.AsyncClient | None = None
+
+    def _get_client(self) -> httpx.AsyncClient:
+        # Created lazily so each worker process (and event loop) gets its own pool
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                timeout=self.timeout,
+                limits=httpx.Limits(max_connections=self.max_connections),
+                headers={"User-Agent": USER_AGENT},
+                cookies=CookieJar(policy=DefaultCookiePolicy(allowed_domains=[])),  # Never stores cookies
+                transport=self.transport
+            )
+        return self._client
+
+    async def _request(self, method: str, url: str, cookies: Dict[str, str], data: List[Tuple[str, str]] | None = None) -> httpx.Response:
+        """One request plus redirects, carrying this lookup's own cookies."""
+        client = self._get_client()
+        for _ in range(MAX_REDIRECTS + 1):
+            headers = {}
+            if cookies:
+                headers["Cookie"] = "; ".join(f"{k}={v}" for k, v in cookies.items())
+            content = None
+            if data is not None:
+                # Encoded by hand: a form may repeat a field name, which a dict can't hold
+                headers["Content-Type"] = "application/x-www-form-urlencoded"
+                content = urlencode(data)
+            response = await client.request(method, url, content=content, headers=headers)
+            cookies.update(response.cookies)
+            if not response.is_redirect:
+                response.raise_for_status()
+                return response
+            url = urljoin(str(response.url), response.headers["Location"])
+            if response.status_code in (301, 302, 303):
+                method, data = "GET", None
+        raise HttpLookupError("Too many redirects")
+
+    async def lookup(self, reference_no: str, date_of_birth: str) -> str:
+        """
+        Returns the status text ("" if the result page shows no status).
+        Raises JavaScriptRequired or HttpLookupError when the browser is needed.
+        """
+        cookies: Dict[str, str] = {}
+        try:
+            # 1. Load the form (for hidden fields such as CSRF tokens)
+            form_page = await self._request("GET", self.url, cookies)
+            page = _parse(form_page.text)
+            form = page.form
+            if form is None or TRACKING_DOB_FIELD_ID not in form["ids"]:
+                if _looks_javascript_only(page):
+                    raise JavaScriptRequired("The tracking form is rendered by JavaScript")
+                raise HttpLookupError("Tracking form not found on the page")
+
+            # 2. Fill in the credentials and submit
+            values = {form["ids"][TRACKING_REF_FIELD_ID]: reference_no, form["ids"][TRACKING_DOB_FIELD_ID]: date_of_birth}
+            fields = [(name, values.get(name, value)) for name, value in form["fields"]]
+            action = urljoin(str(form_page.url), form["action"])
+            if form["method"] == "post":
+                result_page = await self._request("POST", action, cookies, data=fields)
+            else:
+                result_page = await self._request("GET", f"{action.split('?')[0]}?{urlencode(fields)}", cookies)
+        except httpx.HTTPError as e:
+            raise HttpLookupError(f"Tracking request failed: {e}") from e
+
+        # 3. Read the status
+        result = _parse(result_page.text)
+        if result.status_text is None:
+            if _looks_javascript_only(result):
+                raise JavaScriptRequired("The status is rendered by JavaScript")
+            raise HttpLookupError("Status element not found on the result page")
+        return result.status_text
+
+    async def aclose(self) -> None:
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
@@ -0,0 +1,99 @@
+# Concurrent tool execution for the agent's "tools" node.
+# Every tool call of a turn runs at the same time under its own deadline, so
+# a multi-intent turn takes as long as its slowest tool, and a stuck tool
+# becomes a structured timeout result the agent can report instead of
+# blocking the whole turn.
+import asyncio
+import json
+import os
+from typing import Dict, List
+
+from langchain_core.messages import AIMessage, ToolMessage
+from langchain_core.tools import BaseTool
+
+from .admission import AdmissionRejected
+from .logging_setup import get_logger
+from .metrics import AGENT_TOOL_TIMEOUTS
+
+# --- CONFIGURATION ---
+TOOL_TIMEOUT_SECONDS = float(os.environ.get("TOOL_TIMEOUT_SECONDS", 30))
+# Per-tool overrides, e.g. "track_visa_status_tool=45,general_visa_question_tool=20"
+TOOL_TIMEOUTS = {
+    name.strip(): float(seconds)
+    for name, seconds in (item.split("=", 1) for item in os.environ.get("TOOL_TIMEOUTS", "").split(",") if "=" in item)
+}
+
+logger = get_logger("tools")
+
+
+def error_message(tool_call: dict, error: str, message: str, **details) -> ToolMessage:
+    """
+    A ToolMessage for a failed call. The content is JSON for the agent; the
+    same dict is kept as the artifact, with 'message' readable by the user.
+    """
+    result = {"error": error, "tool": tool_call["name"], "message": message, **details}
+    return ToolMessage(
+        content=json.dumps(result), artifact=result, status="error",
+        tool_call_id=tool_call["id"], name=tool_call["name"]
+    )
+
+
+def user_facing_content(message: ToolMessage) -> str:
+    """The text to show the user for a tool result (error results carry their own)."""
+    if message.status == "error" and isinstance(message.artifact, dict) and "message" in message.artifact:
+        return message.artifact["message"]
+    return str(message.content)
+
+
+class ToolExecutor:
+    """Runs the tool calls of the last AIMessage concurrently, each with its own timeout."""
+
+    def __init__(self, tools: List[BaseTool], default_timeout: float = TOOL_TIMEOUT_SECONDS, timeouts: Dict[str, float] | None = None):
+        self.tools_by_name = {tool.name: tool for tool in tools}
+        self.default_timeout = default_timeout
+        self.timeouts = dict(TOOL_TIMEOUTS if timeouts is None else timeouts)
+
+    def timeout_for(self, tool_name: str) -> float:
+        return self.timeouts.get(tool_name, self.default_timeout)
+
+    async def _run_one(self, tool_call: dict) -> ToolMessage:
+        tool = self.tools_by_name.get(tool_call["name"])
+        if tool is None:
+            return error_message(tool_call, "unknown_tool", "Sorry, I tried to use a tool that doesn't exist.")
+
+        timeout = self.timeout_for(tool.name)
+        task = asyncio.ensure_future(tool.ainvoke(tool_call))
+        try:
+            await asyncio.wait({task}, timeout=timeout)
+        except asyncio.CancelledError:
+            # The request went away: stop the tool too
+            task.cancel()
+            raise
+
+        if not task.done():
+            task.cancel()
+            AGENT_TOOL_TIMEOUTS.inc(tool=tool.name)
+            logger.warning("Tool %s timed out after %gs", tool.name, timeout)
+            return error_message(
+                tool_call, "timeout",
+                "Sorry, this is taking longer than expected. Please try again in a moment.",
+                timeout_seconds=timeout
+            )
+        try:
+            return task.result()
+        except AdmissionRejected:
+            raise
+        except Exception as e:
+            logger.exception("Tool %s failed: %s", tool.name, e)
+            return error_message(tool_call, "tool_error", "Sorry, something went wrong while handling your request.")
+
+    async def run(self, state) -> dict:
+        """LangGraph node: one ToolMessage per tool call, in the order they were requested."""
+        message = state['messages'][-1]
+        tool_calls = message.tool_calls if isinstance(message, AIMessage) else []
+        results = await asyncio.gather(*(self._run_one(call) for call in tool_calls), return_exceptions=True)
+        for result in results:
+            # Let the endpoint turn a full LLM queue into a 503
+            if isinstance(result, BaseException):
+                raise result
+        return {"messages": list(results)}
@@ -1,39 +1,38 @@
 import uvicorn
 from fastapi import FastAPI, Request, HTTPException
+from fastapi.responses import PlainTextResponse, StreamingResponse
 from pydantic import BaseModel
-from typing import List, Dict, Any, Annotated, TypedDict
+from typing import List, Dict, Any, AsyncIterator
 from contextlib import asynccontextmanager
 import os
 import sys
-import operator
 import asyncio
-from cachetools import TTLCache
-
-# --- LangChain & LangGraph Imports ---
-from langchain_chroma import Chroma
-from langchain_ollama import OllamaEmbeddings
-from langchain_core.retrievers import BaseRetriever
-from langchain_ollama import ChatOllama
-from langchain_core.tools import tool
-from langchain_core.messages import BaseMessage, HumanMessage, AIMessage, ToolMessage
-from langgraph.graph import StateGraph, END
-from langgraph.prebuilt import ToolNode
-
-# --- Selenium Imports ---
-from selenium import webdriver
-from selenium.webdriver.common.by import By
-from selenium.webdriver.support.ui import WebDriverWait
-from selenium.webdriver.support import expected_conditions as EC
-from selenium.common.exceptions import TimeoutException
+import json
+import time
+
+# --- LangChain Imports ---
+from langchain_core.messages import BaseMessage, HumanMessage, AIMessage
+
+# --- Local Imports ---
+from .admission import AdmissionRejected
+from .session_store import build_session_store, SESSION_STORE
+from .session_locks import SessionLocks, SessionTurn, RequestSuperseded
+from .agent_history import AgentHistoryManager, history_with_summary
+from .agent_factory import get_agent, browser_pool, AGENT_PRELOAD
+from .logging_setup import setup_logging, shutdown_logging, get_logger, bind_user, set_stage, request_context_middleware
+from .metrics import REGISTRY, PROMETHEUS_CONTENT_TYPE
 
 # --- CONFIGURATION ---
-DB_PATH = os.environ.get("DB_PATH", r"D:\Chatbot\practice\chroma_db")
-OLLAMA_MODEL = os.environ.get("OLLAMA_MODEL", "mxbai-embed-large")
-LLM_MODEL = os.environ.get("LLM_MODEL", "llama3.1")
-K_DOCS = int(os.environ.get("K_DOCS", 3))
-MAX_CACHE_SIZE = int(os.environ.get("MAX_CACHE_SIZE", 100))
 SESSION_TTL_SECONDS = int(os.environ.get("SESSION_TTL_SECONDS", 1800)) # 30 mins
 
+logger = get_logger("agent")
+
+# With gunicorn --preload this module is imported once in the master process:
+# build the agent (tools, schemas, compiled graph) there so every worker
+# inherits it copy-on-write. Clients are still connected per worker.
+if AGENT_PRELOAD:
+    get_agent()
+
 # --- Pydantic Models for FastAPI ---
 
 class QueryRequest(BaseModel):
@@ -49,123 +48,6 @@ class QueryResponse(BaseModel):
     # as the agent might not do RAG.
     # We can add logic to extract them from tool calls later if needed.
     
-# --- Vector Store Loading (No Changes) ---
-
-def load_vectorstore(db_path: str, embedding_model: OllamaEmbeddings) -> Chroma | None:
-    """Loads an existing Chroma vector store."""
-    if not os.path.exists(db_path):
-        print(f"Vector store directory {db_path} does not exist.")
-        return None
-    try:
-        print(f"Loading vector store from {db_path}...")
-        vectorstore = Chroma(
-            persist_directory=db_path,
-            embedding_function=embedding_model
-        )
-        print("Vector store loaded successfully.")
-        return vectorstore
-    except Exception as e:
-        print(f"Error loading vector store: {e}")
-        return None
-    
-def setup_retriever(vectorstore) -> BaseRetriever | None:
-    """Sets up a retriever from the vector store."""
-    if vectorstore is None:
-        print("Vector store is None, cannot set up retriever.")
-        return None
-    return vectorstore.as_retriever(
-        search_type="similarity",
-        search_kwargs={"k": K_DOCS}
-    )
-
-# -----------------------------------------------------------------
-# --- AGENT TOOLS ---
-# -----------------------------------------------------------------
-
-@tool
-async def track_visa_status_tool(reference_no: str, date_of_birth: str) -> str:
-    """
-    Use this tool *only* when a user asks to track their visa application status.
-    You MUST have both the 'reference_no' (application reference number)
-    and 'date_of_birth' (in YYYY-MM-DD format) before calling this.
-    If you don't have them, ask the user for them.
-    """
-    print(f"--- Calling Visa Tracker Tool for {reference_no} ---")
-    
-    # This function contains blocking I/O (Selenium)
-    # We must run it in a separate thread to avoid blocking FastAPI's event loop
-    def blocking_selenium_call():
-        TRACKING_URL = "https://www.bls-website.com/track-application" # <-- REPLACE
-        REF_FIELD_ID = "application_ref_id" # <-- REPLACE
-        DOB_FIELD_ID = "dob_field_id"       # <-- REPLACE
-        SUBMIT_BUTTON_ID = "submit_button_id" # <-- REPLACE
-        STATUS_RESULT_ID = "status_result_element_id" # <-- REPLACE
-
-        options = webdriver.ChromeOptions()
-        options.add_argument("--headless")
-        options.add_argument("--no-sandbox")
-        options.add_argument("--disable-dev-shm-usage")
-        
-        try:
-            with webdriver.Chrome(options=options) as driver:
-                driver.get(TRACKING_URL)
-                ref_field = WebDriverWait(driver, 10).until(
-                    EC.presence_of_element_located((By.ID, REF_FIELD_ID))
-                )
-                dob_field = driver.find_element(By.ID, DOB_FIELD_ID)
-                ref_field.send_keys(reference_no)
-                dob_field.send_keys(date_of_birth)
-                
-                submit_button = driver.find_element(By.ID, SUBMIT_BUTTON_ID)
-                submit_button.click()
-                
-                status_element = WebDriverWait(driver, 10).until(
-                    EC.presence_of_element_located((By.ID, STATUS_RESULT_ID))
-                )
-                status = status_element.text
-                
-                if not status:
-                    return "Successfully submitted, but no status was found. Please check details."
-                return f"The status for application {reference_no} is: {status}"
-        except TimeoutException:
-            return "Error: The tracking page timed out."
-        except Exception as e:
-            print(f"[Tool Error]: {e}")
-            return "Sorry, I was unable to retrieve the status."
-
-    # Run the blocking function in a thread pool
-    return await asyncio.to_thread(blocking_selenium_call)
-
-# Note: The RAG tool will be defined inside the lifespan
-# to give it access to the retriever and llm
-
-# -----------------------------------------------------------------
-# --- LANGGRAPH AGENT DEFINITION ---
-# -----------------------------------------------------------------
-
-class AgentState(TypedDict):
-    """This is the state of our graph, a list of messages."""
-    messages: Annotated[List[BaseMessage], operator.add]
-
-async def call_agent_node(state, llm_with_tools):
-    """This node calls the LLM (agent)."""
-    print("--- Calling Agent Node ---")
-    messages = state['messages']
-    # We use .ainvoke for async calling
-    response = await llm_with_tools.ainvoke(messages)
-    return {"messages": [response]}
-
-def should_run_tools(state) -> str:
-    """This is the router. It checks if the LLM called a tool."""
-    print("--- Checking for Tools ---")
-    last_message = state['messages'][-1]
-    if last_message.tool_calls:
-        print("-> Decision: Run tools")
-        return "run_tools"
-    else:
-        print("-> Decision: End")
-        return END
-
 # -----------------------------------------------------------------
 # --- FastAPI Lifespan (Startup/Shutdown) ---
 # -----------------------------------------------------------------
@@ -174,84 +56,39 @@ def should_run_tools(state) -> str:
 async def lifespan(app: FastAPI):
     """
     Manages the startup and shutdown logic for the FastAPI app.
-    Loads all RAG components and builds the LangGraph agent on startup.
+    Connects this worker's RAG components to the (possibly preloaded) agent.
     """
     print("--- Server is starting up, loading RAG components ---")
-
-    # 1. Load Embedding Model
-    embedding_model = OllamaEmbeddings(model=OLLAMA_MODEL)
-    app.state.EMBEDDING_MODEL = embedding_model
-
-    # 2. Load Vector Store
-    vectorstore = load_vectorstore(DB_PATH, embedding_model)
-    app.state.RAG_VECTORSTORE = vectorstore
-
-    # 3. Setup Retriever
-    retriever = setup_retriever(vectorstore)
-    app.state.RAG_RETRIEVER = retriever
-
-    # 4. Initialize LLM
-    llm = ChatOllama(model=LLM_MODEL, temperature=0.4)
-    app.state.RAG_LLM = llm
-    
-    if retriever is None or llm is None:
-        print("FATAL: Failed to load LLM or Retriever. Agent will not function.")
+    setup_logging()
+
+    # 1. Get the agent (already built in the master process with AGENT_PRELOAD)
+    agent = get_agent()
+    app.state.AGENT = agent
+    print(f"--- LangGraph Agent ready (preloaded={AGENT_PRELOAD}, return_direct={sorted(agent.return_direct)}). ---")
+
+    # 2. Connect this worker's clients (embeddings, vector store, LLM) and warm the browser pool
+    app.state.LLM_LIMITER = agent.limiter
+    if not await agent.start_worker():
+        print("FATAL: Failed to load LLM or vector store. Agent will not function.")
+        app.state.AGENT_APP = None
         yield
         return # Don't continue if critical components failed
-
-    # --- 5. Build the Agent (NEW) ---
-    
-    # Define the RAG tool *inside* lifespan to "close over"
-    # the retriever and llm from app.state
-    @tool
-    async def general_visa_question_tool(query: str) -> str:
-        """
-        Use this tool for all general questions about visa processes,
-        document requirements, fees, application centers, or any other question
-        that is NOT a request to track a specific application status.
-        """
-        print(f"--- Calling RAG Tool for: {query} ---")
-        try:
-            # Use the components from app.state
-            context_docs = await app.state.RAG_RETRIEVER.ainvoke(query)
-            context_text = "\n".join([doc.page_content for doc in context_docs])
-            
-            rag_prompt = f"Context: {context_text}\n\nQuestion: {query}\nAnswer concisely."
-            result = await app.state.RAG_LLM.ainvoke(rag_prompt)
-            return result.content
-        except Exception as e:
-            print(f"[RAG Tool Error]: {e}")
-            return "Sorry, I encountered an error trying to find an answer."
-
-    # Setup tools
-    tools = [track_visa_status_tool, general_visa_question_tool]
-    llm_with_tools = llm.bind_tools(tools)
-    
-    # Assemble the graph
-    graph = StateGraph(AgentState)
-    
-    # We use a lambda to pass the llm_with_tools to the node
-    graph.add_node(
-        "agent",
-        lambda state: call_agent_node(state, llm_with_tools)
-    )
-    graph.add_node("tools", ToolNode(tools))
-    
-    graph.set_entry_point("agent")
-    graph.add_conditional_edges("agent", should_run_tools, {"run_tools": "tools", END: END})
-    graph.add_edge("tools", "agent")
-    
-    # Compile the graph and store it in app.state
-    app.state.AGENT_APP = graph.compile()
-    print("--- LangGraph Agent compiled and loaded. ---")
-
-    # 6. Setup Memory Cache
-    # This cache will store `List[BaseMessage]` for each user
-    app.state.RAG_MEMORIES = TTLCache(
-        maxsize=MAX_CACHE_SIZE,
-        ttl=SESSION_TTL_SECONDS
-    )
-    print(f"Per-user memory manager initialized (size={MAX_CACHE_SIZE}, ttl={SESSION_TTL_SECONDS}s).")
+    app.state.EMBEDDING_MODEL = agent.embeddings
+    app.state.AGENT_APP = agent.graph
+    app.state.BROWSER_POOL = browser_pool
+    print(f"Browser pool started ({browser_pool.stats()['idle']}/{browser_pool.size} sessions warm, max_uses={browser_pool.max_uses}).")
+
+    # 3. Setup Session Store
+    # Stores each user's `List[BaseMessage]` in serialized form (memory, sqlite or redis)
+    app.state.SESSION_STORE = build_session_store()
+    print(f"Session store initialized (backend={SESSION_STORE}, ttl={SESSION_TTL_SECONDS}s).")
+    # Requests of one user are serialized so concurrent turns can't overwrite each other's history
+    app.state.SESSION_LOCKS = SessionLocks()
+    print(f"Per-user request serialization enabled (cancel_superseded={app.state.SESSION_LOCKS.cancel_superseded}).")
+    # Histories are compacted to a token budget before they are stored
+    app.state.HISTORY_MANAGER = AgentHistoryManager(llm=agent.llm, limiter=agent.limiter)
+    history_manager = app.state.HISTORY_MANAGER
+    print(f"Agent history manager initialized (max_tokens={history_manager.max_tokens}, tool_policy={history_manager.tool_policy}, summarize={history_manager.summarize}).")
     
     print("--- Server startup complete. ---")
     
@@ -259,9 +96,12 @@ async def lifespan(app: FastAPI):
 
     # --- Shutdown Logic ---
     print("--- Server is shutting down ---")
-    app.state.RAG_MEMORIES.clear()
-    print("Memory cache cleared.")
+    await app.state.SESSION_STORE.close()
+    print("Session store closed.")
+    await agent.aclose()
+    print("Embedding batcher, browser pool and tracking HTTP client closed.")
     print("--- Shutdown complete ---")
+    shutdown_logging()
 
 
 # -----------------------------------------------------------------
@@ -275,10 +115,41 @@ app = FastAPI(
     lifespan=lifespan
 )
 
+# Attach a request_id to every log record written while handling a request
+app.middleware("http")(request_context_middleware)
+
 @app.get("/", tags=["General"])
-async def read_root():
-    """A simple health check endpoint."""
-    return {"status": "ok", "message": "Welcome to the Agentic RAG Chatbot API"}
+async def read_root(request: Request):
+    """A simple health check endpoint, including the current LLM queue depth."""
+    limiter = getattr(request.app.state, "LLM_LIMITER", None)
+    session_locks = getattr(request.app.state, "SESSION_LOCKS", None)
+    return {
+        "status": "ok",
+        "message": "Welcome to the Agentic RAG Chatbot API",
+        "llm_queue": limiter.stats() if limiter else None,
+        "sessions": session_locks.stats() if session_locks else None,
+        "browser_pool": browser_pool.stats()
+    }
+
+
+@app.get("/metrics", tags=["General"])
+async def read_metrics():
+    """Agent node/tool latency histograms, token counts and cache hit ratios in Prometheus format."""
+    return PlainTextResponse(REGISTRY.render(), media_type=PROMETHEUS_CONTENT_TYPE)
+
+
+async def load_chat_history(session_store, user_id: str):
+    """Returns (messages to replay, summary) for the user; empty if there is no (unexpired) session."""
+    session = await session_store.get(user_id)
+    if session is None:
+        return [], ""
+    return history_with_summary(session["messages"], session["summary"]), session["summary"]
+
+
+async def save_chat_history(app_state, user_id: str, messages: List[BaseMessage], summary: str) -> None:
+    """Compacts the history (stale tool messages, token budget) and stores it."""
+    stored_messages, summary = await app_state.HISTORY_MANAGER.compact(messages, summary)
+    await app_state.SESSION_STORE.set(user_id, stored_messages, summary)
 
 
 @app.post("/query", response_model=QueryResponse, tags=["Agent"])
@@ -295,54 +166,188 @@ async def handle_agent_query(request: Request, body: QueryRequest):
     try:
         # Access components from app.state
         agent_app = request.app.state.AGENT_APP
-        memory_cache = request.app.state.RAG_MEMORIES 
+        session_store = request.app.state.SESSION_STORE
         
-        if agent_app is None or memory_cache is None:
+        if agent_app is None or session_store is None:
             raise HTTPException(status_code=500, detail="Agent is not initialized.")
 
+        # Reject straight away if the LLM queue is already full
+        limiter = request.app.state.LLM_LIMITER
+        if limiter.is_full():
+            raise AdmissionRejected("LLM wait queue is full", limiter.retry_after())
+
         # Get or create memory for the user
         user_id = body.user_id if body.user_id else "default-user"
+        bind_user(user_id)
         
-        # .get() returns None if not found, so [] is a default
-        chat_history = memory_cache.get(user_id, [])
+        # Turns of one user run one at a time, so each one sees and extends the previous history
+        async def run_turn(turn: SessionTurn) -> str:
+            chat_history, summary = await load_chat_history(session_store, user_id)
 
-        # Format the input for the agent
-        current_messages = chat_history + [HumanMessage(content=body.query)]
-        
-        # 3. Invoke the agent (asynchronously)
-        print(f"Invoking agent for user: {user_id}...")
-        result_state = await agent_app.ainvoke(
-            {"messages": current_messages},
-            # Add a recursion limit
-            {"recursion_limit": 10}
-        )
-        print("Agent invocation complete.")
-
-        # 4. Get the full, updated history from the result
-        new_chat_history = result_state['messages']
-
-        # 5. Save the new history back to the cache
-        memory_cache[user_id] = new_chat_history
-
-        # 6. Get the final answer (it's the last message)
-        response_content = new_chat_history[-1].content
+            # Format the input for the agent
+            current_messages = chat_history + [HumanMessage(content=body.query)]
+            
+            # 3. Invoke the agent (asynchronously)
+            logger.info("Invoking agent")
+            result_state = await agent_app.ainvoke(
+                {"messages": current_messages},
+                # Add a recursion limit
+                {"recursion_limit": 10}
+            )
+            set_stage(None)
+            logger.info("Agent invocation complete")
+
+            # 4. Get the full, updated history from the result
+            new_chat_history = result_state['messages']
+
+            # 5. Compact the history (stale tool messages, token budget) and save it to the session store
+            # (a newer message no longer cancels the turn from here on)
+            turn.protect()
+            await save_chat_history(request.app.state, user_id, new_chat_history, summary)
+
+            # 6. Get the final answer (it's the last message)
+            return new_chat_history[-1].content
+
+        async with request.app.state.SESSION_LOCKS.turn(user_id) as turn:
+            response_content = await turn.run(run_turn(turn))
         
         return QueryResponse(
             original_query=body.query,
             response=response_content
         )
+
+    except RequestSuperseded:
+        # The same user sent a newer message; that one gets the answer
+        raise HTTPException(status_code=409, detail="Superseded by a newer message from the same user.")
+
+    except AdmissionRejected as e:
+        # Too many generations in flight; tell the client when to come back
+        logger.warning("Rejected query: %s", e)
+        raise HTTPException(
+            status_code=503,
+            detail="The server is busy. Please retry shortly.",
+            headers={"Retry-After": str(e.retry_after)}
+        )
         
     except Exception as e:
-        print(f"--- UNHANDLED ERROR ---")
-        print(f"Error handling query for user {body.user_id}: {e}")
-        import traceback
-        traceback.print_exc()
-        print(f"--- END TRACEBACK ---")
+        logger.exception("Error handling query: %s", e)
         raise HTTPException(
             status_code=500,
             detail=f"An internal server error occurred."
         )
 
+# Progress messages shown to the user while the graph runs
+NODE_MESSAGES = {
+    "router": "Reading your question...",
+    "agent": "Thinking...",
+    "finish": "Preparing the answer...",
+}
+TOOL_MESSAGES = {
+    "track_visa_status_tool": "Checking your application...",
+    "general_visa_question_tool": "Looking through the visa information...",
+}
+
+
+def sse_event(event: str, data: dict) -> str:
+    """Formats one Server-Sent Event."""
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+@app.post("/query/stream", tags=["Agent"])
+async def handle_agent_query_stream(request: Request, body: QueryRequest):
+    """
+    Streaming variant of /query, as Server-Sent Events built from the graph's event stream.
+    - "node": a graph node started ("phase": "start", with a progress message) or ended ("phase": "end", with duration_ms).
+    - "tool": a tool started or ended, likewise.
+    - "token": a chunk of LLM output (the "node" field says which node produced it).
+    - "done": the final response; "error" if the turn failed.
+    Every event carries elapsed_ms since the request started. History is saved before "done".
+    """
+    agent_app = request.app.state.AGENT_APP
+    session_store = request.app.state.SESSION_STORE
+    if agent_app is None or session_store is None:
+        raise HTTPException(status_code=500, detail="Agent is not initialized.")
+
+    # Reject up front while we can still send a status code
+    limiter = request.app.state.LLM_LIMITER
+    if limiter.is_full():
+        raise HTTPException(
+            status_code=503,
+            detail="The server is busy. Please retry shortly.",
+            headers={"Retry-After": str(limiter.retry_after())}
+        )
+
+    user_id = body.user_id if body.user_id else "default-user"
+    bind_user(user_id)
+    started = time.perf_counter()
+
+    def elapsed_ms(since: float = started) -> int:
+        return int((time.perf_counter() - since) * 1000)
+
+    async def agent_events(turn: SessionTurn) -> AsyncIterator[str]:
+        run_started: Dict[str, float] = {}
+
+        try:
+            chat_history, summary = await load_chat_history(session_store, user_id)
+            current_messages = chat_history + [HumanMessage(content=body.query)]
+
+            logger.info("Streaming agent")
+            final_state = None
+            async for event in agent_app.astream_events(
+                {"messages": current_messages}, {"recursion_limit": 10}, version="v2"
+            ):
+                kind = event["event"]
+                name = event["name"]
+                node = event.get("metadata", {}).get("langgraph_node")
+
+                if kind == "on_chain_start" and name == node:
+                    run_started[event["run_id"]] = time.perf_counter()
+                    yield sse_event("node", {"node": name, "phase": "start", "message": NODE_MESSAGES.get(name), "elapsed_ms": elapsed_ms()})
+                elif kind == "on_chain_end" and name == node and event["run_id"] in run_started:
+                    duration = elapsed_ms(run_started.pop(event["run_id"]))
+                    yield sse_event("node", {"node": name, "phase": "end", "duration_ms": duration, "elapsed_ms": elapsed_ms()})
+                elif kind == "on_tool_start":
+                    run_started[event["run_id"]] = time.perf_counter()
+                    yield sse_event("tool", {"tool": name, "phase": "start", "message": TOOL_MESSAGES.get(name), "elapsed_ms": elapsed_ms()})
+                elif kind == "on_tool_end" and event["run_id"] in run_started:
+                    duration = elapsed_ms(run_started.pop(event["run_id"]))
+                    yield sse_event("tool", {"tool": name, "phase": "end", "duration_ms": duration, "elapsed_ms": elapsed_ms()})
+                elif kind == "on_chat_model_stream":
+                    content = event["data"]["chunk"].content
+                    if content:
+                        yield sse_event("token", {"node": node, "content": content, "elapsed_ms": elapsed_ms()})
+                elif kind == "on_chain_end" and not event.get("parent_ids"):
+                    # The graph itself finished
+                    final_state = event["data"]["output"]
+            set_stage(None)
+
+            new_chat_history = final_state['messages']
+            turn.protect()
+            await save_chat_history(request.app.state, user_id, new_chat_history, summary)
+            logger.info("Agent stream complete")
+            yield sse_event("done", {"response": new_chat_history[-1].content, "elapsed_ms": elapsed_ms()})
+
+        except AdmissionRejected as e:
+            # Headers are already sent, so report the rejection in-band
+            logger.warning("Rejected streaming query: %s", e)
+            yield sse_event("error", {"detail": "The server is busy. Please retry shortly.", "retry_after": e.retry_after})
+
+        except Exception as e:
+            # Headers are already sent, so report the error in-band
+            logger.exception("Error streaming query: %s", e)
+            yield sse_event("error", {"detail": "An internal server error occurred while processing your request."})
+
+    async def event_stream() -> AsyncIterator[str]:
+        # Turns of one user run one at a time; a newer message may cancel this one mid-stream
+        try:
+            async with request.app.state.SESSION_LOCKS.turn(user_id) as turn:
+                async for event in turn.iterate(agent_events(turn)):
+                    yield event
+        except RequestSuperseded:
+            yield sse_event("error", {"detail": "Superseded by a newer message from the same user.", "superseded": True, "elapsed_ms": elapsed_ms()})
+
+    return StreamingResponse(event_stream(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
+
 # --- To run the app ---
 if __name__ == "__main__":
     """
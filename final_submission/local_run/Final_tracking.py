@@ -16,12 +16,15 @@ from langgraph.graph import StateGraph, END
 from langgraph.prebuilt import ToolNode
 
 # --- Selenium Imports (same as before) ---
-from selenium import webdriver
 from selenium.webdriver.common.by import By
 from selenium.webdriver.support.ui import WebDriverWait
 from selenium.webdriver.support import expected_conditions as EC
 from selenium.common.exceptions import TimeoutException
 
+# Reuse the backend's warm browser session class
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "backend"))
+from app.browser_pool import BrowserSession
+
 # --- Your existing constants ---
 DB_PATH = os.environ.get("DB_PATH", r"D:\Chatbot\practice\chroma_db")
 OLLAMA_MODEL = os.environ.get("OLLAMA_MODEL", "mxbai-embed-large")
@@ -56,6 +59,25 @@ def setup_retriever(vectorstore)-> BaseRetriever | None:
 # --- STEP 1: DEFINE YOUR TOOLS ---
 # -----------------------------------------------------------------
 
+# One warm browser for the whole chat session (this script handles one lookup at a time)
+_browser: BrowserSession | None = None
+
+def get_browser() -> BrowserSession:
+    """Returns the warm browser, relaunching it if it died or reached its use limit."""
+    global _browser
+    if _browser is not None and (_browser.expired or not _browser.is_healthy()):
+        _browser.quit()
+        _browser = None
+    if _browser is None:
+        _browser = BrowserSession()
+    return _browser
+
+def close_browser():
+    global _browser
+    if _browser is not None:
+        _browser.quit()
+        _browser = None
+
 # --- Tool 1 (Global) ---
 @tool
 def track_visa_status_tool(reference_no: str, date_of_birth: str) -> str:
@@ -77,48 +99,55 @@ def track_visa_status_tool(reference_no: str, date_of_birth: str) -> str:
     SUBMIT_BUTTON_ID = "submit_button_id" # <-- REPLACE THIS
     STATUS_RESULT_ID = "status_result_element_id" # <-- REPLACE THIS
 
-    # Setup the browser
-    options = webdriver.ChromeOptions()
-    options.add_argument("--headless") # Run in background
-    options.add_argument("--no-sandbox")
-    options.add_argument("--disable-dev-shm-usage")
-    
+    session = None
     try:
-        with webdriver.Chrome(options=options) as driver:
-            driver.get(TRACKING_URL)
+        # Reuse the running browser instead of launching a new one
+        session = get_browser()
+        driver = session.driver
+        session.uses += 1
+        driver.get(TRACKING_URL)
 
-            # 2. Find the form fields and fill them
-            ref_field = WebDriverWait(driver, 10).until(
-                EC.presence_of_element_located((By.ID, REF_FIELD_ID))
-            )
-            dob_field = driver.find_element(By.ID, DOB_FIELD_ID)
-            
-            ref_field.send_keys(reference_no)
-            dob_field.send_keys(date_of_birth) # Assumes YYYY-MM-DD format
+        # 2. Find the form fields and fill them
+        ref_field = WebDriverWait(driver, 10).until(
+            EC.presence_of_element_located((By.ID, REF_FIELD_ID))
+        )
+        dob_field = driver.find_element(By.ID, DOB_FIELD_ID)
+        
+        ref_field.send_keys(reference_no)
+        dob_field.send_keys(date_of_birth) # Assumes YYYY-MM-DD format
 
-            # 3. Find and click the submit button
-            submit_button = driver.find_element(By.ID, SUBMIT_BUTTON_ID)
-            submit_button.click()
+        # 3. Find and click the submit button
+        submit_button = driver.find_element(By.ID, SUBMIT_BUTTON_ID)
+        submit_button.click()
 
-            # 4. Wait for the result to appear
-            status_element = WebDriverWait(driver, 10).until(
-                EC.presence_of_element_located((By.ID, STATUS_RESULT_ID))
-            )
+        # 4. Wait for the result to appear
+        status_element = WebDriverWait(driver, 10).until(
+            EC.presence_of_element_located((By.ID, STATUS_RESULT_ID))
+        )
 
-            # 5. Extract the text
-            status = status_element.text
+        # 5. Extract the text
+        status = status_element.text
+        
+        if not status:
+            return "Successfully submitted, but no status was found. Please check the details and try again."
             
-            if not status:
-                return "Successfully submitted, but no status was found. Please check the details and try again."
-                
-            return f"The status for application {reference_no} is: {status}"
+        return f"The status for application {reference_no} is: {status}"
 
     except TimeoutException:
         return f"Error: The tracking page timed out. The details might be incorrect or the website is down."
     except Exception as e:
-        # Handle other errors (e.g., element not found)
+        # Handle other errors (e.g., element not found); start a fresh browser next time
         print(f"[Tool Error]: {e}")
+        close_browser()
+        session = None
         return "Sorry, I was unable to retrieve the status. The reference number or DOB might be incorrect, or the tracking service is unavailable."
+    finally:
+        # Clear cookies and the half-filled page before the next lookup, also after a timeout
+        if session is not None:
+            try:
+                session.reset()
+            except Exception:
+                close_browser()
 
 
 # -----------------------------------------------------------------
@@ -229,6 +258,12 @@ def main():
     # --- STEP 5: THE MAIN LOOP
     # -----------------------------------------------------------------
     
+    # Launch the browser now so the first tracking request doesn't pay for it
+    try:
+        get_browser()
+    except Exception as e:
+        print(f"Could not pre-launch browser (will retry on first lookup): {e}")
+
     print("LangGraph Chatbot is ready! Ask me a general question or ask to track your visa.")
     
     chat_history = []
@@ -237,6 +272,7 @@ def main():
         query = input("Ask your question (or type 'exit' to quit): ")
         if query.lower() in ['exit', 'quit']:
             print("Exiting the program.")
+            close_browser()
             break
         
         current_messages = chat_history + [HumanMessage(content=query)]
@@ -1,168 +1,542 @@
 import os
+import sys
+import json
 import shutil
+import hashlib
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from functools import lru_cache
+from typing import Iterator
+import chromadb
 from langchain_chroma import Chroma
 from langchain_ollama import OllamaEmbeddings
 from langchain_community.document_loaders import UnstructuredWordDocumentLoader
 from langchain_core.documents import Document
 from langchain_text_splitters import CharacterTextSplitter
-from sklearn.metrics.pairwise import cosine_similarity
 import numpy as np 
+import tiktoken
+
+# The embedding cache lives in the backend package so both sides share it
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "backend"))
+from app.embedding_cache import build_cached_embeddings
 
 BASE_DIR = os.environ.get("BASE_DIR", r"D:\Chatbot\practice\Knowledge_Base")
 OLLAMA_MODEL = os.environ.get("OLLAMA_MODEL", "mxbai-embed-large")
-SIM_THRESHOLD = os.environ.get("SIM_THRESHOLD", 0.53)
+SIM_THRESHOLD = float(os.environ.get("SIM_THRESHOLD", 0.53))
+# Chunk size limits in tokens (mxbai-embed-large reads at most 512 tokens)
+CHUNK_MAX_TOKENS = int(os.environ.get("CHUNK_MAX_TOKENS", 512))
+CHUNK_MIN_TOKENS = int(os.environ.get("CHUNK_MIN_TOKENS", 32))
+# Sentences repeated from the end of the previous chunk (fewer if the chunk would exceed CHUNK_MAX_TOKENS)
+CHUNK_OVERLAP_SENTENCES = int(os.environ.get("CHUNK_OVERLAP_SENTENCES", 0))
+# The tokenizer the sentence splitter counts with
+TOKEN_ENCODING = "gpt2"
+DB_PATH = os.environ.get("INGEST_DB_PATH", "./chroma_db")
+# LangChain's default collection, which the backends read
+COLLECTION_NAME = "langchain"
+# incremental: only re-embed new/changed files and drop removed ones; full: rebuild from scratch
+INGEST_MODE = os.environ.get("INGEST_MODE", "incremental")
+MANIFEST_NAME = "ingest_manifest.json"
+# .docx parsing is CPU-bound: one process per worker
+INGEST_PARSE_WORKERS = int(os.environ.get("INGEST_PARSE_WORKERS", os.cpu_count() or 1))
+# Chunking and embedding wait on Ollama: this many files are embedded at once
+INGEST_EMBED_CONCURRENCY = int(os.environ.get("INGEST_EMBED_CONCURRENCY", 4))
+# Files parsed or chunked ahead of the vector store writes (bounds memory when the writes fall behind)
+INGEST_MAX_IN_FLIGHT = int(os.environ.get("INGEST_MAX_IN_FLIGHT", 8))
+# Chunks per vector store write; the manifest (the resume checkpoint) is saved after each batch
+INGEST_BATCH_SIZE = int(os.environ.get("INGEST_BATCH_SIZE", 256))
+REBUILD_MARKER = "ingest_rebuild.inprogress"
+# embed: embed each chunk's text; pooled: average the chunk's sentence embeddings (no extra embedding calls)
+CHUNK_EMBEDDINGS = os.environ.get("CHUNK_EMBEDDINGS", "embed")
 
 
-def semantic_chunker(doc: Document, embeddings: OllamaEmbeddings, similarity_threshold: float) -> list[Document]:
+def normalize_rows(vectors: np.ndarray) -> np.ndarray:
+    """Scales each row to unit length (zero rows stay zero)."""
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+def adjacent_similarities(unit_vectors: np.ndarray) -> np.ndarray:
     """
-    Splits a document into semantic chunks based on cosine similarity of sentence embeddings.
+    Cosine similarity of each sentence with the next one.
+    A row-wise dot product of unit vectors: O(n) memory, unlike the full n x n similarity matrix.
+    """
+    return np.einsum("ij,ij->i", unit_vectors[:-1], unit_vectors[1:])
+
+
+@lru_cache(maxsize=1)
+def _token_encoding() -> tiktoken.Encoding:
+    return tiktoken.get_encoding(TOKEN_ENCODING)
+
+
+def count_tokens(text: str) -> int:
+    """Number of tokens in 'text', counted like the sentence splitter does."""
+    return len(_token_encoding().encode(text))
+
+
+def plan_chunks(similarities: np.ndarray, token_counts: list[int], similarity_threshold: float,
+                max_tokens: int = CHUNK_MAX_TOKENS, min_tokens: int = CHUNK_MIN_TOKENS) -> list[tuple[int, int]]:
+    """
+    Picks the chunk boundaries for a run of sentences.
+    1. Split wherever the similarity of neighbouring sentences drops below the threshold.
+    2. Split chunks over max_tokens again at their lowest similarity, until they fit
+       (a single sentence over the limit stays as it is).
+    3. Merge chunks under min_tokens into the more similar neighbour, if the result fits.
+    Args:
+        similarities (np.ndarray): Similarity of each sentence with the next (n - 1 values).
+        token_counts (list[int]): Tokens in each sentence (n values).
+        similarity_threshold (float): The cosine similarity threshold to determine chunk boundaries.
+        max_tokens (int): The largest chunk wanted.
+        min_tokens (int): The smallest chunk wanted.
+    Returns:
+        list[tuple[int, int]]: (start, end) sentence ranges, end exclusive.
+    """
+
+    cumulative = np.concatenate([[0], np.cumsum(token_counts)])
+
+    def size(start: int, end: int) -> int:
+        return int(cumulative[end] - cumulative[start])
+
+    split_points = [0, *(np.flatnonzero(similarities < similarity_threshold) + 1).tolist(), len(token_counts)]
+    pending = list(zip(split_points[:-1], split_points[1:]))
+
+    # 2. Split oversized chunks at their weakest link
+    chunks = []
+    while pending:
+        start, end = pending.pop(0)
+        if size(start, end) <= max_tokens or end - start == 1:
+            chunks.append((start, end))
+            continue
+        split = start + 1 + int(np.argmin(similarities[start:end - 1]))
+        pending[:0] = [(start, split), (split, end)]
+
+    # 3. Merge undersized chunks into the neighbour they are most similar to
+    i = 0
+    while i < len(chunks):
+        start, end = chunks[i]
+        if size(start, end) >= min_tokens or len(chunks) == 1:
+            i += 1
+            continue
+        options = []
+        if i > 0 and size(chunks[i - 1][0], end) <= max_tokens:
+            options.append((similarities[start - 1], i - 1))
+        if i + 1 < len(chunks) and size(start, chunks[i + 1][1]) <= max_tokens:
+            options.append((similarities[end - 1], i + 1))
+        if not options:
+            i += 1
+            continue
+        _, neighbour = max(options)
+        first, second = sorted((i, neighbour))
+        chunks[first:second + 1] = [(chunks[first][0], chunks[second][1])]
+        # Check the merged chunk again: it may still be too small
+        i = first
+
+    return chunks
+
+
+def semantic_chunks_with_embeddings(doc: Document, embeddings: OllamaEmbeddings, similarity_threshold: float,
+                                    max_tokens: int = CHUNK_MAX_TOKENS, min_tokens: int = CHUNK_MIN_TOKENS,
+                                    overlap_sentences: int = CHUNK_OVERLAP_SENTENCES) -> tuple[list[Document], np.ndarray]:
+    """
+    Splits a document into semantic chunks based on cosine similarity of sentence embeddings,
+    keeping chunk sizes between min_tokens and max_tokens where possible (see plan_chunks).
+    Each chunk's token count is stored in its 'token_count' metadata.
     Args:
         doc (Document): The document to be chunked.
         embeddings (OllamaEmbeddings): The embedding model to generate sentence embeddings.
         similarity_threshold (float): The cosine similarity threshold to determine chunk boundaries.
+        max_tokens (int): The largest chunk wanted.
+        min_tokens (int): The smallest chunk wanted.
+        overlap_sentences (int): Sentences repeated from the end of the previous chunk, as many
+            as fit in max_tokens.
     Returns:
-        list[Document]: A list of semantic chunk documents.
+        tuple[list[Document], np.ndarray]: The chunks, and for each chunk the normalized
+        mean of its sentence embeddings (one row per chunk).
     """
 
     text_splitter = CharacterTextSplitter.from_tiktoken_encoder(
-        separator=". ", chunk_size=50, chunk_overlap=0
+        encoding_name=TOKEN_ENCODING, separator=". ", chunk_size=50, chunk_overlap=0
     )
     sentences = text_splitter.split_text(doc.page_content)
     
     if not sentences:
-        return []
-
-    sentence_embeddings = embeddings.embed_documents(sentences)
-
-    embeddings_array = np.array(sentence_embeddings)
-    
-    similarities = np.diag(
-        cosine_similarity(embeddings_array[:-1], embeddings_array[1:])
-    ).tolist()
+        return [], np.empty((0, 0), dtype=np.float32)
 
-    split_points = [0]
-    for i, sim in enumerate(similarities):
-        if sim < similarity_threshold:
-            split_points.append(i + 1)
-    split_points.append(len(sentences))
+    sentence_vectors = normalize_rows(np.asarray(embeddings.embed_documents(sentences), dtype=np.float32))
+    similarities = adjacent_similarities(sentence_vectors)
+    token_counts = [count_tokens(sentence) for sentence in sentences]
 
     semantic_chunks = []
-    for i in range(len(split_points) - 1):
-        start_index = split_points[i]
-        end_index = split_points[i+1]
-        
+    pooled_vectors = []
+    previous_start = 0
+    for chunk_start, end_index in plan_chunks(similarities, token_counts, similarity_threshold, max_tokens, min_tokens):
+        # The overlap never reaches back past the start of the previous chunk
+        start_index = max(chunk_start - overlap_sentences, previous_start)
+        previous_start = chunk_start
         chunk_text = " ".join(sentences[start_index:end_index])
+        # Drop overlap sentences (oldest first) until the chunk fits the embedding model again
+        while start_index < chunk_start and count_tokens(chunk_text) > max_tokens:
+            start_index += 1
+            chunk_text = " ".join(sentences[start_index:end_index])
+        metadata = dict(doc.metadata)
+        metadata['token_count'] = count_tokens(chunk_text)
+        semantic_chunks.append(Document(page_content=chunk_text, metadata=metadata))
+        pooled_vectors.append(sentence_vectors[start_index:end_index].mean(axis=0))
         
-        new_doc = Document(page_content=chunk_text, metadata=doc.metadata)
-        
-        semantic_chunks.append(new_doc)
-        
-    return semantic_chunks
+    return semantic_chunks, normalize_rows(np.array(pooled_vectors))
+
+
+def semantic_chunker(doc: Document, embeddings: OllamaEmbeddings, similarity_threshold: float) -> list[Document]:
+    """
+    Splits a document into semantic chunks based on cosine similarity of sentence embeddings.
+    Args:
+        doc (Document): The document to be chunked.
+        embeddings (OllamaEmbeddings): The embedding model to generate sentence embeddings.
+        similarity_threshold (float): The cosine similarity threshold to determine chunk boundaries.
+    Returns:
+        list[Document]: A list of semantic chunk documents.
+    """
+    return semantic_chunks_with_embeddings(doc, embeddings, similarity_threshold)[0]
 
 
 
-def ingest_and_chunk_documents(base_dir: str, embeddings: OllamaEmbeddings, similarity_threshold: float) -> list[Document]:
+def find_documents(base_dir: str) -> list[tuple[str, str]]:
     """
-    Ingests .docx documents from country-specific subdirectories, chunks them semantically, and returns all chunks.
+    Lists the .docx files under each country's 'docx' folder.
     Args:
         base_dir (str): The base directory containing country subdirectories with 'docx' folders.
-        embeddings (OllamaEmbeddings): The embedding model to use for chunking.
-        similarity_threshold (float): The cosine similarity threshold for chunking.
     Returns:
-        list[Document]: A list of all semantic chunk documents.
+        list[tuple[str, str]]: (country name, file path) pairs, sorted so runs are deterministic.
     """
 
-    all_chunks = []
-    
-    for country_folder in os.listdir(base_dir):
+    found = []
+    for country_folder in sorted(os.listdir(base_dir)):
         country_path = os.path.join(base_dir, country_folder)
-        
-        if os.path.isdir(country_path) and not country_folder.startswith('.'):
-            country_name = country_folder
-            docx_path = os.path.join(country_path, 'docx')
-            
-            if os.path.isdir(docx_path):
-                print(f"Processing documents for {country_name}...")
-                
-                for file_name in os.listdir(docx_path):
-                    if file_name.endswith('.docx'):
-                        file_path = os.path.join(docx_path, file_name)
-                        
-                        try:
-
-                            loader = UnstructuredWordDocumentLoader(file_path)
-                            loaded_docs = loader.load()
-                            
-                            for doc in loaded_docs:
-                                
-                                doc.metadata['country'] = country_name
-                                
-                                chunks = semantic_chunker(doc, embeddings, similarity_threshold)
-                                all_chunks.extend(chunks)
-                                
-                        except Exception as e:
-                            print(f"Error processing {file_name} in {country_name}: {e}")
-                            
-    return all_chunks
-
-
-def initiating_vectorstore(db_path: str, embedding_model, chunked_documents) -> Chroma | None:
-    """
-    Creates and persists a Chroma vector store from chunked documents.
+        docx_path = os.path.join(country_path, 'docx')
+
+        if os.path.isdir(country_path) and not country_folder.startswith('.') and os.path.isdir(docx_path):
+            for file_name in sorted(os.listdir(docx_path)):
+                if file_name.endswith('.docx'):
+                    found.append((country_folder, os.path.join(docx_path, file_name)))
+    return found
+
+
+def parse_file(file_path: str, country_name: str) -> list[Document]:
+    """
+    Loads one .docx file and tags it with its country. Runs in a worker process.
     Args:
-        db_path (str): The directory path where the Chroma vector store will be persisted.
-        embedding_model: The embedding model to use with the vector store.
-        chunked_documents (list[Document]): The list of chunked documents to be added to the vector store.
+        file_path (str): The .docx file to load.
+        country_name (str): Stored in each document's 'country' metadata.
     Returns:
-        Chroma or None: The created Chroma vector store or None if creation fails."""
-    
-    try:
-        print(f"Creating and persisting vector store at {db_path}...")
-        vectorstore = Chroma.from_documents(
-            documents=chunked_documents, 
-            embedding=embedding_model,
-            persist_directory=db_path
-        )
-        print("Vector store created successfully.")
+        list[Document]: The loaded documents.
+    """
 
-    except Exception as e:
-        print(f"Error creating vector store: {e}")
-        vectorstore = None
-    return vectorstore
+    loader = UnstructuredWordDocumentLoader(file_path)
+    loaded_docs = loader.load()
+    for doc in loaded_docs:
+        doc.metadata['country'] = country_name
+    return loaded_docs
 
 
+def chunk_documents(loaded_docs: list[Document], embeddings: OllamaEmbeddings, similarity_threshold: float,
+                    chunk_embeddings: str = CHUNK_EMBEDDINGS) -> list[tuple[Document, list[float]]]:
+    """
+    Chunks the documents of one file semantically and gives every chunk its
+    vector, so the vector store doesn't embed anything. Runs in a worker thread.
+    Args:
+        loaded_docs (list[Document]): The documents of one file.
+        embeddings (OllamaEmbeddings): The embedding model to use for chunking.
+        similarity_threshold (float): The cosine similarity threshold for chunking.
+        chunk_embeddings (str): "embed" to embed each chunk's text, "pooled" to reuse its sentence embeddings.
+    Returns:
+        list[tuple[Document, list[float]]]: The semantic chunks of the file and their embeddings.
+    """
 
-def main():
+    chunks = []
+    pooled = []
+    for doc in loaded_docs:
+        doc_chunks, doc_vectors = semantic_chunks_with_embeddings(doc, embeddings, similarity_threshold)
+        chunks.extend(doc_chunks)
+        pooled.extend(doc_vectors.tolist())
+    if not chunks:
+        return []
+    if chunk_embeddings == "pooled":
+        vectors = pooled
+    else:
+        # Single-sentence chunks come straight from the embedding cache
+        vectors = embeddings.embed_documents([chunk.page_content for chunk in chunks])
+    return list(zip(chunks, vectors))
 
-    try:
-        print("Initializing embedding model...")
-        embedding_model = OllamaEmbeddings(model= OLLAMA_MODEL)
-    except Exception as e:
-        print(f"Error initializing embedding model: {e}")
+
+def chunk_files_parallel(files: list[tuple[str, str]], embeddings: OllamaEmbeddings, similarity_threshold: float,
+                         parse_workers: int = INGEST_PARSE_WORKERS,
+                         embed_concurrency: int = INGEST_EMBED_CONCURRENCY,
+                         max_in_flight: int = INGEST_MAX_IN_FLIGHT) -> Iterator[tuple[str, list[tuple[Document, list[float]]] | Exception]]:
+    """
+    Parses files in a process pool and chunks/embeds them in a thread pool.
+    Each file moves on to embedding as soon as it is parsed, but results come
+    back in the order of 'files', so the output is the same on every run.
+    At most 'max_in_flight' files are started ahead of the consumer, so a slow
+    consumer holds back the pools instead of letting results pile up in memory.
+    Args:
+        files (list[tuple[str, str]]): (country name, file path) pairs.
+        embeddings (OllamaEmbeddings): The embedding model to use for chunking.
+        similarity_threshold (float): The cosine similarity threshold for chunking.
+        parse_workers (int): Number of parsing processes.
+        embed_concurrency (int): Number of files chunked and embedded at once.
+        max_in_flight (int): Number of files started but not yet consumed.
+    Yields:
+        tuple[str, list[tuple[Document, list[float]]] | Exception]: The file path and its chunks with their
+        embeddings, or the error it failed with.
+    """
+
+    if not files:
         return
 
+    def copy_result(source: Future, target: Future) -> None:
+        if source.exception() is not None:
+            target.set_exception(source.exception())
+        else:
+            target.set_result(source.result())
 
-    chunked_documents = ingest_and_chunk_documents(BASE_DIR, embedding_model, SIM_THRESHOLD)
+    # The process pool is shut down first, while its callbacks can still hand work to the threads
+    with ThreadPoolExecutor(max_workers=embed_concurrency) as embed_pool, \
+            ProcessPoolExecutor(max_workers=min(parse_workers, len(files))) as parse_pool:
 
+        def start_chunking(parsed: Future, result: Future) -> None:
+            if parsed.exception() is not None:
+                result.set_exception(parsed.exception())
+                return
+            chunked = embed_pool.submit(chunk_documents, parsed.result(), embeddings, similarity_threshold)
+            chunked.add_done_callback(lambda done: copy_result(done, result))
+
+        def start(country_name: str, file_path: str) -> Future:
+            result = Future()
+            parsed = parse_pool.submit(parse_file, file_path, country_name)
+            parsed.add_done_callback(lambda done: start_chunking(done, result))
+            return result
+
+        remaining = iter(files)
+        in_flight = deque()
+        for country_name, file_path in remaining:
+            in_flight.append((file_path, start(country_name, file_path)))
+            if len(in_flight) >= max(max_in_flight, 1):
+                break
+
+        while in_flight:
+            file_path, result = in_flight.popleft()
+            error = result.exception()
+            # Start the next file before handing this one over
+            for country_name, next_path in remaining:
+                in_flight.append((next_path, start(country_name, next_path)))
+                break
+            yield file_path, error if error is not None else result.result()
+
+
+# --- Incremental ingestion ---
+
+def file_sha256(file_path: str) -> str:
+    """Returns the SHA-256 of a file's contents."""
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def chunk_ids(relative_path: str, content_hash: str, count: int) -> list[str]:
+    """Stable chunk ids for one version of a file, so its chunks can be found and deleted later."""
+    prefix = hashlib.sha256(f"{relative_path}\x00{content_hash}".encode("utf-8")).hexdigest()[:16]
+    return [f"{prefix}-{i}" for i in range(count)]
+
+
+def load_manifest(manifest_path: str) -> dict | None:
+    """
+    Reads the ingestion manifest: {relative path: {"mtime", "sha256", "chunk_ids"}}.
+    Returns None if there is none yet.
+    """
+    if not os.path.exists(manifest_path):
+        return None
+    with open(manifest_path, "r", encoding="utf-8") as f:
+        return json.load(f)
 
-    original_doc_sources = set(
-        doc.metadata.get('source') 
-        for doc in chunked_documents 
-        if doc.metadata.get('source') is not None
-    )
-    
 
-    print(f"\nFinished ingesting and chunking.")
-    print(f"Total original documents processed: {len(original_doc_sources)}")
-    print(f"Total semantic chunks created: {len(chunked_documents)}")
+def save_manifest(manifest_path: str, manifest: dict) -> None:
+    """Writes the manifest atomically, so an interrupted run never leaves a half-written file."""
+    temp_path = manifest_path + ".tmp"
+    with open(temp_path, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(temp_path, manifest_path)
 
 
-    db_path = "./chroma_db"
-    if os.path.exists(db_path):
-        print(f"!!! WARNING: Removing existing database at {db_path} to perform full rebuild. !!!")
-        shutil.rmtree(db_path)
+def incremental_ingest(base_dir: str, db_path: str, embedding_model, similarity_threshold: float,
+                       batch_size: int = INGEST_BATCH_SIZE, parse_workers: int = INGEST_PARSE_WORKERS,
+                       embed_concurrency: int = INGEST_EMBED_CONCURRENCY) -> dict:
+    """
+    Brings the vector store in line with the .docx files under base_dir.
+    New or changed files (by content hash; the mtime is only a shortcut) are re-chunked
+    and their old chunks replaced, chunks of removed files are deleted, and unchanged
+    files are left alone. The manifest is saved next to the database after every
+    batch, so an interrupted run picks up after the last written batch.
+    Args:
+        base_dir (str): The base directory containing country subdirectories with 'docx' folders.
+        db_path (str): The Chroma persist directory.
+        embedding_model: The embedding model for chunking and for the vector store.
+        similarity_threshold (float): The cosine similarity threshold for chunking.
+        batch_size (int): Chunks per vector store write.
+        parse_workers (int): Maximum number of parsing processes.
+        embed_concurrency (int): Number of files chunked and embedded at once.
+    Returns:
+        dict: Counts of added, updated, removed, unchanged and failed files.
+    """
+
+    manifest_path = os.path.join(db_path, MANIFEST_NAME)
+    manifest = load_manifest(manifest_path) or {}
+    os.makedirs(db_path, exist_ok=True)
+    # The LangChain wrapper creates the collection the way the backends expect; the chunks are
+    # written straight to the chromadb collection, with the vectors computed while chunking
+    client = chromadb.PersistentClient(path=db_path)
+    Chroma(client=client, collection_name=COLLECTION_NAME, embedding_function=embedding_model)
+    collection = client.get_collection(COLLECTION_NAME)
+    counts = {"added": 0, "updated": 0, "removed": 0, "unchanged": 0, "failed": 0}
+
+    # 1. Find the new and changed files
+    seen = set()
+    pending = {}
+    for country_name, file_path in find_documents(base_dir):
+        relative_path = os.path.relpath(file_path, base_dir)
+        seen.add(relative_path)
+        entry = manifest.get(relative_path)
+        mtime = os.path.getmtime(file_path)
+
+        # Same mtime: assume unchanged without reading the file
+        if entry is not None and entry["mtime"] == mtime:
+            counts["unchanged"] += 1
+            continue
+        content_hash = file_sha256(file_path)
+        if entry is not None and entry["sha256"] == content_hash:
+            entry["mtime"] = mtime
+            counts["unchanged"] += 1
+            continue
+        pending[file_path] = (country_name, relative_path, mtime, content_hash)
+
+    # 2. Parse, chunk and embed them in parallel; store the results in file order, in batches
+    files = [(country_name, file_path) for file_path, (country_name, *_) in pending.items()]
+    # The process pool is never bigger than the number of files
+    print(f"Ingesting {len(pending)} new or changed files ({min(parse_workers, len(files))} parse workers, {embed_concurrency} embedding threads, batch size {batch_size}, {CHUNK_EMBEDDINGS} chunk embeddings)...")
+    failures = []
+    batch = []  # (chunk, vector, id) not written yet
+    batch_files = {}  # Manifest entries of the files whose chunks are all in 'batch'
+    stale_ids = []  # Previous chunk ids of the changed files in 'batch'
+
+    def write_batch() -> None:
+        """
+        Writes the pending chunks, then deletes the chunks they replace and
+        checkpoints the files they complete. A changed file always has one
+        version in the collection, even if the run is interrupted in between.
+        """
+        for start in range(0, len(batch), batch_size):
+            part = batch[start:start + batch_size]
+            # Upserts with the vectors computed while chunking, so nothing is embedded twice
+            # (and rewriting chunks after an interruption is harmless)
+            collection.upsert(
+                ids=[chunk_id for _, _, chunk_id in part],
+                embeddings=[vector for _, vector, _ in part],
+                documents=[chunk.page_content for chunk, _, _ in part],
+                metadatas=[chunk.metadata for chunk, _, _ in part]
+            )
+        new_ids = {chunk_id for _, _, chunk_id in batch}
+        old_ids = [chunk_id for chunk_id in stale_ids if chunk_id not in new_ids]
+        if old_ids:
+            collection.delete(ids=old_ids)
+        manifest.update(batch_files)
+        save_manifest(manifest_path, manifest)
+        batch.clear()
+        batch_files.clear()
+        stale_ids.clear()
+
+    for file_path, chunks in chunk_files_parallel(files, embedding_model, similarity_threshold,
+                                                  parse_workers=parse_workers, embed_concurrency=embed_concurrency):
+        country_name, relative_path, mtime, content_hash = pending[file_path]
+        entry = manifest.get(relative_path)
+        try:
+            if isinstance(chunks, Exception):
+                raise chunks
+            print(f"{'Updating' if entry else 'Adding'} {relative_path} ({len(chunks)} chunks)...")
+            ids = chunk_ids(relative_path, content_hash, len(chunks))
+        except Exception as e:
+            print(f"Error processing {relative_path}: {e}")
+            failures.append((relative_path, e))
+            counts["failed"] += 1
+            continue
+
+        batch.extend((chunk, vector, chunk_id) for (chunk, vector), chunk_id in zip(chunks, ids))
+        batch_files[relative_path] = {"mtime": mtime, "sha256": content_hash, "chunk_ids": ids}
+        if entry is not None:
+            # Deleted by write_batch once the new chunks are in
+            stale_ids.extend(entry["chunk_ids"])
+        counts["updated" if entry else "added"] += 1
+        if len(batch) >= batch_size:
+            write_batch()
+    write_batch()
+
+    for relative_path in sorted(set(manifest) - seen):
+        print(f"Removing {relative_path}...")
+        removed_ids = manifest.pop(relative_path)["chunk_ids"]
+        if removed_ids:
+            collection.delete(ids=removed_ids)
+        counts["removed"] += 1
+
+    save_manifest(manifest_path, manifest)
+    if failures:
+        print(f"{len(failures)} file(s) failed and will be retried on the next run:")
+        for relative_path, error in failures:
+            print(f"  {relative_path}: {type(error).__name__}: {error}")
+    return counts
+
+
+def full_rebuild(base_dir: str, db_path: str, embedding_model, similarity_threshold: float) -> None:
+    """
+    Deletes the database and re-ingests every document, then writes a fresh manifest
+    so later runs can be incremental. If a previous rebuild was interrupted, it is
+    resumed from its last checkpoint instead of starting over.
+    """
+
+    marker_path = os.path.join(db_path, REBUILD_MARKER)
+    if os.path.exists(marker_path):
+        print(f"Resuming the interrupted full rebuild of {db_path}...")
+    else:
+        if os.path.exists(db_path):
+            print(f"!!! WARNING: Removing existing database at {db_path} to perform full rebuild. !!!")
+            shutil.rmtree(db_path)
+        os.makedirs(db_path)
+        open(marker_path, "w").close()
+
+    counts = incremental_ingest(base_dir, db_path, embedding_model, similarity_threshold)
+    os.remove(marker_path)
+    print(f"Total original documents processed: {counts['added']}")
+    print(f"Total documents that failed: {counts['failed']}")
+
+
+def main():
+
+    try:
+        print("Initializing embedding model...")
+        embedding_model = build_cached_embeddings(OLLAMA_MODEL)
+    except Exception as e:
+        print(f"Error initializing embedding model: {e}")
+        return
 
-    vectorstore = initiating_vectorstore(db_path, embedding_model, chunked_documents)
+    manifest_exists = os.path.exists(os.path.join(DB_PATH, MANIFEST_NAME))
+    rebuild_interrupted = os.path.exists(os.path.join(DB_PATH, REBUILD_MARKER))
+    if INGEST_MODE == "full" or not manifest_exists or rebuild_interrupted:
+        if INGEST_MODE != "full" and not rebuild_interrupted:
+            # Without a manifest the existing chunks can't be matched to files
+            print("No ingestion manifest found, performing a full rebuild.")
+        full_rebuild(BASE_DIR, DB_PATH, embedding_model, SIM_THRESHOLD)
+    else:
+        counts = incremental_ingest(BASE_DIR, DB_PATH, embedding_model, SIM_THRESHOLD)
+        print(f"\nFinished incremental ingestion.")
+        print(", ".join(f"{name}: {count}" for name, count in counts.items()))
 
 if __name__ == "__main__":
     main()
@@ -1,4 +1,5 @@
 import os
+import sys
 from langchain_chroma import Chroma
 from langchain_ollama import OllamaEmbeddings
 from langchain_core.retrievers import BaseRetriever
@@ -6,6 +7,10 @@ import streamlit as st
 from typing import List, Tuple
 from langchain_core.documents import Document
 
+# The embedding cache lives in the backend package so both sides share it
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "backend"))
+from app.embedding_cache import build_cached_embeddings
+
 # --- Configuration Constants ---
 db_path = os.environ.get("DB_PATH", r"D:\Chatbot\practice\chroma_db")
 OLLAMA_MODEL = os.environ.get("OLLAMA_MODEL", "mxbai-embed-large")
@@ -21,7 +26,7 @@ def initialize_embedding_model(model_name: str) -> OllamaEmbeddings | None:
     try:
         # Streamlit print messages go to the terminal running the app
         print(f"Initializing embedding model: {model_name}...")
-        return OllamaEmbeddings(model=model_name)
+        return build_cached_embeddings(model_name)
     except Exception as e:
         st.error(f"FATAL ERROR: Could not initialize Ollama Embeddings model '{model_name}'.")
         st.error(f"Ensure the Ollama server is running and the model is pulled. Details: {e}")